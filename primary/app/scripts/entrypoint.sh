@@ -21,8 +21,19 @@ iptables -A OUTPUT -d 49.235.186.64 -p udp --dport 51823 -j TRAFFIC_US
 iptables -A OUTPUT -d 212.64.83.18 -p udp --dport 51822 -j TRAFFIC_SG
 iptables -A OUTPUT -j TRAFFIC_TOTAL
 
+# 记录链建立时间（计数器已清零，采集器据此识别复位）
+mkdir -p /var/lib/sing-box
+date +%s > /var/lib/sing-box/iptables_epoch
+
 echo "   ✓ iptables规则设置完成"
 
+# 客户端统计模式：nftables动态集合按客户端IP计数
+if [ "${CLIENT_ACCOUNTING:-0}" = "1" ]; then
+    echo "   设置nftables客户端统计规则（${CLIENT_SUBNET:-192.168.9.0/24}）..."
+    (cd /app && python3 -c "import asyncio; from server.client_accounting import ClientAccounting; asyncio.run(ClientAccounting.setup_nftables_rules())")
+    echo "   ✓ nftables规则设置完成"
+fi
+
 # 2. 确保目录存在
 echo "2. 创建必要目录..."
 mkdir -p /var/lib/sing-box
@@ -36,7 +47,15 @@ cp /app/frontend/index.html /var/www/html/
 
 # 4. 检查sing-box配置
 echo "4. 检查sing-box配置..."
-if [ ! -f "/etc/sing-box/config.json" ]; then
+# sing-box运行/run下的副本，配置管理API可替换后热重载（挂载的配置为只读）
+# 配置管理API生效过的配置优先，删除 /var/lib/sing-box/config.rendered.json 可回到挂载的配置
+mkdir -p /run/sing-box
+if [ -f "/var/lib/sing-box/config.rendered.json" ]; then
+    echo "   使用配置管理API生成的配置"
+    cp /var/lib/sing-box/config.rendered.json /run/sing-box/config.json
+elif [ -f "/etc/sing-box/config.json" ]; then
+    cp /etc/sing-box/config.json /run/sing-box/config.json
+else
     echo "   ⚠️  警告: /etc/sing-box/config.json 不存在"
     echo "   请确保已挂载配置文件"
 fi
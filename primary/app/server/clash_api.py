@@ -0,0 +1,361 @@
+"""
+Clash API客户端模块
+共享的异步httpx客户端：连接复用、单次调用截止时间、指数退避重试和熔断
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Any, AsyncIterator, Dict, Optional
+from urllib.parse import quote
+import logging
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+class ClashAPIError(Exception):
+    """Clash API调用失败（status_code为sing-box返回的HTTP状态码，未收到响应时为None）"""
+    
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class CircuitOpenError(ClashAPIError):
+    """熔断中，暂不调用Clash API"""
+
+class CircuitBreaker:
+    """熔断器
+    
+    连续失败达到阈值后打开，期间直接拒绝调用；
+    冷却时间过后进入半开状态，只放行一个试探调用，成功则关闭，失败则重新打开。
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+    
+    @property
+    def state(self) -> str:
+        """当前状态"""
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+    
+    def before_call(self) -> bool:
+        """调用前检查，熔断中抛出CircuitOpenError
+        
+        Returns:
+            本次调用是否占用了半开状态的试探名额
+        """
+        state = self.state
+        if state == self.OPEN:
+            raise CircuitOpenError("Clash API熔断中")
+        if state == self.HALF_OPEN:
+            if self.trial_in_flight:
+                raise CircuitOpenError("Clash API熔断中（试探调用进行中）")
+            self.trial_in_flight = True
+            return True
+        return False
+    
+    def release_trial(self):
+        """归还试探名额（试探调用被取消、没有结果时），不改变熔断状态"""
+        self.trial_in_flight = False
+    
+    def record_success(self):
+        """记录成功，关闭熔断"""
+        if self.opened_at is not None:
+            logger.info("Clash API恢复，熔断关闭")
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+    
+    def record_failure(self):
+        """记录失败，达到阈值或试探失败时打开熔断"""
+        self.failures += 1
+        half_open = self.trial_in_flight
+        self.trial_in_flight = False
+        if half_open or self.failures >= self.failure_threshold:
+            if self.opened_at is None or half_open:
+                logger.warning(f"Clash API连续失败{self.failures}次，熔断{self.reset_timeout}秒")
+            self.opened_at = time.monotonic()
+    
+    def as_dict(self) -> Dict:
+        """导出状态"""
+        return {"state": self.state, "consecutive_failures": self.failures}
+
+class ClashAPIClient:
+    """sing-box Clash API客户端（整个应用共享一个实例）"""
+    
+    BASE_URL = "http://127.0.0.1:9090"
+    
+    # 单次调用的默认截止时间（秒，包含重试）
+    DEFAULT_DEADLINE = 3.0
+    
+    # 幂等请求的重试次数和退避基数（秒）
+    MAX_RETRIES = 2
+    BACKOFF_BASE = 0.2
+    
+    # 连接池
+    MAX_CONNECTIONS = 10
+    MAX_KEEPALIVE = 5
+    
+    def __init__(self, base_url: Optional[str] = None, secret: Optional[str] = None):
+        self.base_url = base_url or os.environ.get("CLASH_API_URL", self.BASE_URL)
+        self.secret = secret if secret is not None else os.environ.get("CLASH_API_SECRET", "")
+        self.client: Optional[httpx.AsyncClient] = None
+        self.breaker = CircuitBreaker()
+        # 按端点统计：调用次数、失败次数、总耗时、最大耗时（毫秒）
+        self.metrics: Dict[str, Dict[str, float]] = {}
+    
+    async def start(self):
+        """创建共享的连接池"""
+        if self.client is not None:
+            return
+        headers = {"Authorization": f"Bearer {self.secret}"} if self.secret else {}
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers=headers,
+            limits=httpx.Limits(
+                max_connections=self.MAX_CONNECTIONS,
+                max_keepalive_connections=self.MAX_KEEPALIVE
+            ),
+            timeout=httpx.Timeout(self.DEFAULT_DEADLINE)
+        )
+    
+    async def close(self):
+        """关闭连接池"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+    
+    # ==================== 普通调用 ====================
+    
+    async def request(self, method: str, path: str, *, params: Optional[Dict] = None,
+                      json_body: Any = None, deadline: Optional[float] = None,
+                      retries: Optional[int] = None, use_breaker: bool = True) -> Any:
+        """调用Clash API并返回解码后的JSON
+        
+        GET请求失败时在截止时间内按指数退避重试；每次尝试都计入熔断器。
+        
+        Args:
+            method: HTTP方法
+            path: 路径，如 /connections
+            params: 查询参数
+            json_body: 请求体
+            deadline: 截止时间（秒），默认DEFAULT_DEADLINE
+            retries: 重试次数，默认GET请求为MAX_RETRIES，其他为0
+            use_breaker: 是否受熔断器控制并计入其失败次数
+        """
+        if self.client is None:
+            raise ClashAPIError("Clash API客户端未启动")
+        
+        deadline = deadline or self.DEFAULT_DEADLINE
+        end = time.monotonic() + deadline
+        if retries is None:
+            retries = self.MAX_RETRIES if method.upper() == "GET" else 0
+        attempt = 0
+        
+        while True:
+            trial = self.breaker.before_call() if use_breaker else False
+            start = time.perf_counter()
+            try:
+                remaining = max(0.05, end - time.monotonic())
+                response = await asyncio.wait_for(
+                    self.client.request(method, path, params=params, json=json_body,
+                                        timeout=remaining),
+                    timeout=remaining
+                )
+                response.raise_for_status()
+                if use_breaker:
+                    self.breaker.record_success()
+                self._record(path, start, ok=True)
+                return self._decode(path, response)
+            except (httpx.HTTPError, asyncio.TimeoutError) as e:
+                self._record(path, start, ok=False)
+                if isinstance(e, httpx.HTTPStatusError):
+                    status = e.response.status_code
+                    # 4xx是调用方的问题，不算Clash API故障，也不重试；
+                    # 不计入熔断的调用（如延迟测试）的5xx来自出站而非sing-box本身
+                    if status < 500 or not use_breaker:
+                        if use_breaker:
+                            self.breaker.record_success()
+                        raise ClashAPIError(
+                            f"Clash API {path} 返回 {status}: {self._error_message(e.response)}",
+                            status_code=status
+                        )
+                if not use_breaker:
+                    raise ClashAPIError(f"Clash API {path} 调用失败: {e!r}")
+                self.breaker.record_failure()
+                error = e
+            finally:
+                # 试探调用被取消（任务取消、服务关闭）时record_*都不会执行，需归还名额，
+                # 否则熔断器一直停在半开状态，之后的调用全部被拒绝
+                if trial:
+                    self.breaker.release_trial()
+            
+            backoff = self.BACKOFF_BASE * (2 ** attempt) * (0.5 + random.random())
+            # 熔断已打开时不再重试，直接报告本次错误
+            if (attempt >= retries or time.monotonic() + backoff >= end
+                    or self.breaker.state != CircuitBreaker.CLOSED):
+                raise ClashAPIError(f"Clash API {path} 调用失败: {error!r}")
+            attempt += 1
+            await asyncio.sleep(backoff)
+    
+    async def get(self, path: str, **kwargs) -> Any:
+        """GET请求"""
+        return await self.request("GET", path, **kwargs)
+    
+    @staticmethod
+    def _decode(path: str, response: httpx.Response) -> Any:
+        """解码响应体，无法解码时抛出ClashAPIError"""
+        if not response.content:
+            return None
+        try:
+            return response.json()
+        except ValueError as e:
+            raise ClashAPIError(f"Clash API {path} 响应无法解码: {e}")
+    
+    @staticmethod
+    def _error_message(response: httpx.Response) -> str:
+        """sing-box错误响应中的message字段"""
+        try:
+            return response.json().get("message", "")
+        except (ValueError, AttributeError):
+            return response.text[:200]
+    
+    # ==================== 流式调用 ====================
+    
+    async def stream(self, path: str, *, params: Optional[Dict] = None,
+                     max_items: Optional[int] = None,
+                     deadline: Optional[float] = None) -> AsyncIterator[Any]:
+        """逐行读取流式端点（/traffic、/memory、/logs等），每行解码为JSON
+        
+        数据边到边解码，不缓存整个响应；连接建立的成败计入熔断器。
+        
+        Args:
+            path: 路径
+            params: 查询参数
+            max_items: 读取到该行数后结束
+            deadline: 建立连接和读取首行的截止时间（秒）
+        """
+        if self.client is None:
+            raise ClashAPIError("Clash API客户端未启动")
+        
+        trial = self.breaker.before_call()
+        start = time.perf_counter()
+        deadline = deadline or self.DEFAULT_DEADLINE
+        count = 0
+        try:
+            async with self.client.stream("GET", path, params=params,
+                                          timeout=httpx.Timeout(deadline, read=None)) as response:
+                response.raise_for_status()
+                self.breaker.record_success()
+                trial = False
+                self._record(path, start, ok=True)
+                lines = response.aiter_lines()
+                while True:
+                    # 首行受截止时间约束，之后按流的节奏读取
+                    if count == 0:
+                        line = await asyncio.wait_for(lines.__anext__(), timeout=deadline)
+                    else:
+                        line = await lines.__anext__()
+                    if not line.strip():
+                        continue
+                    try:
+                        item = json.loads(line)
+                    except ValueError as e:
+                        raise ClashAPIError(f"Clash API {path} 数据无法解码: {e}")
+                    yield item
+                    count += 1
+                    if max_items is not None and count >= max_items:
+                        break
+        except StopAsyncIteration:
+            return
+        except (httpx.HTTPError, asyncio.TimeoutError) as e:
+            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code < 500:
+                # 与request相同：4xx是调用方的问题，不算Clash API故障
+                self._record(path, start, ok=False)
+                self.breaker.record_success()
+                raise ClashAPIError(f"Clash API {path} 返回 {e.response.status_code}",
+                                    status_code=e.response.status_code)
+            if count == 0:
+                self._record(path, start, ok=False)
+                self.breaker.record_failure()
+            raise ClashAPIError(f"Clash API {path} 流读取失败: {e!r}")
+        finally:
+            # 建立连接期间被取消时归还试探名额（同request）
+            if trial:
+                self.breaker.release_trial()
+    
+    # ==================== 常用端点 ====================
+    
+    async def traffic_sample(self) -> Dict:
+        """读取一个实时速率样本 {"up": 字节/秒, "down": 字节/秒}"""
+        samples = self.stream("/traffic", max_items=1)
+        try:
+            async for item in samples:
+                return item
+        finally:
+            await samples.aclose()
+        raise ClashAPIError("Clash API /traffic 没有返回数据")
+    
+    async def connections(self) -> Dict:
+        """当前连接列表和累计上下行字节"""
+        return await self.get("/connections")
+    
+    async def proxy_delay(self, name: str, url: str, timeout_ms: int = 5000) -> Dict:
+        """测试出站延迟
+        
+        出站不通时sing-box返回503/504，这是出站的状态而不是sing-box故障，
+        因此测速不计入熔断器，失败时通过ClashAPIError.status_code把状态码交给调用方。
+        """
+        return await self.get(
+            f"/proxies/{quote(name, safe='')}/delay",
+            params={"url": url, "timeout": timeout_ms},
+            # 截止时间比测速超时略长，且测速不重试
+            deadline=timeout_ms / 1000 + 1,
+            retries=0,
+            use_breaker=False
+        )
+    
+    # ==================== 统计 ====================
+    
+    def _record(self, path: str, start: float, ok: bool):
+        """记录一次调用的耗时和结果"""
+        elapsed = (time.perf_counter() - start) * 1000
+        # 带参数的路径按首段归类，避免统计项无限增长
+        key = "/" + path.strip("/").split("/")[0]
+        m = self.metrics.setdefault(key, {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+        m["calls"] += 1
+        if not ok:
+            m["errors"] += 1
+        m["total_ms"] += elapsed
+        m["max_ms"] = max(m["max_ms"], elapsed)
+    
+    def stats(self) -> Dict:
+        """导出熔断状态和各端点统计"""
+        return {
+            "base_url": self.base_url,
+            "breaker": self.breaker.as_dict(),
+            "endpoints": {
+                key: {
+                    "calls": int(m["calls"]),
+                    "errors": int(m["errors"]),
+                    "avg_ms": round(m["total_ms"] / m["calls"], 2) if m["calls"] else 0,
+                    "max_ms": round(m["max_ms"], 2)
+                }
+                for key, m in self.metrics.items()
+            }
+        }
@@ -0,0 +1,223 @@
+"""
+局域网客户端流量统计模块
+使用nftables动态集合为每个客户端IP维护计数器（内核哈希查找，与客户端数量无关）
+"""
+
+import asyncio
+import json
+import os
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ClientAccounting:
+    """客户端流量统计器
+    
+    nftables表中有两个动态集合，元素为客户端IP，每个元素自带计数器：
+    - client_tx: 客户端发出的流量（prerouting，源地址为客户端）
+    - client_rx: 发往客户端的流量（postrouting，目的地址为客户端）
+    
+    客户端流量经TUN进入sing-box后才选择出站，内核看不到出站标签，
+    因此按客户端和方向统计，线路维度仍由TrafficCollector负责。
+    """
+    
+    NFT_FAMILY = "inet"
+    NFT_TABLE = "traffic_clients"
+    SETS = {"client_tx": "tx_bytes", "client_rx": "rx_bytes"}
+    
+    # 采集间隔（秒）
+    SAMPLE_INTERVAL = 60
+    
+    # 集合最大元素数（超出后新客户端不再计数）
+    SET_SIZE = 65535
+    
+    def __init__(self, database):
+        self.db = database
+        self.running = False
+        self.task = None
+        self.enabled = self.is_enabled()
+        self.subnet = self.client_subnet()
+        
+        # 上一次的计数器基线：(客户端IP, 集合) -> 字节数，启动后从数据库加载
+        self.baseline: Optional[Dict[Tuple[str, str], int]] = None
+    
+    @staticmethod
+    def is_enabled() -> bool:
+        """是否开启客户端统计模式（环境变量CLIENT_ACCOUNTING=1）"""
+        return os.environ.get("CLIENT_ACCOUNTING", "0").lower() in ("1", "true", "yes")
+    
+    @staticmethod
+    def client_subnet() -> str:
+        """局域网网段（环境变量CLIENT_SUBNET）"""
+        return os.environ.get("CLIENT_SUBNET", "192.168.9.0/24")
+    
+    async def start(self):
+        """启动客户端统计"""
+        if not self.enabled:
+            return
+        if self.running:
+            logger.warning("客户端流量统计已在运行")
+            return
+        
+        self.running = True
+        self.task = asyncio.create_task(self._collect_loop())
+        logger.info(f"客户端流量统计已启动: {self.subnet}")
+    
+    async def stop(self):
+        """停止客户端统计"""
+        if not self.running:
+            return
+        self.running = False
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        logger.info("客户端流量统计已停止")
+    
+    async def _collect_loop(self):
+        """采集循环"""
+        while self.running:
+            try:
+                await self._collect()
+                await asyncio.sleep(self.SAMPLE_INTERVAL)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"客户端流量采集失败: {e}")
+                await asyncio.sleep(self.SAMPLE_INTERVAL)
+    
+    async def _collect(self):
+        """读取全部客户端计数器并保存增量"""
+        counters = await self._read_nft_counters()
+        hour = datetime.now().replace(minute=0, second=0, microsecond=0)
+        if self.baseline is None:
+            self.baseline = await self.db.get_client_baseline()
+            if self.baseline is None:
+                # 从未建立过基线（新库或首次升级）：集合元素已有的累计计数只作为基线，
+                # 不整体计入当前小时（与TrafficCollector的检查点相同）
+                await self.db.save_client_deltas(hour, {}, counters)
+                self.baseline = counters
+                logger.info(f"客户端流量统计建立基线: {len(counters)}个计数器")
+                return
+        
+        deltas = self._compute_deltas(self.baseline, counters)
+        await self.db.save_client_deltas(hour, deltas, counters)
+        self.baseline = counters
+        
+        if deltas:
+            logger.debug(f"客户端流量采集: {len(deltas)}个客户端有流量")
+    
+    def _compute_deltas(self, baseline: Dict[Tuple[str, str], int],
+                        counters: Dict[Tuple[str, str], int]) -> Dict[str, Dict[str, int]]:
+        """计算各客户端的增量
+        
+        新出现的元素和计数回退的元素（表被重建）按当前计数计入。
+        
+        Returns:
+            客户端IP -> {"tx_bytes": .., "rx_bytes": ..}
+        """
+        deltas: Dict[str, Dict[str, int]] = {}
+        for (client, set_name), value in counters.items():
+            last = baseline.get((client, set_name))
+            delta = value - last if last is not None and value >= last else value
+            if delta <= 0:
+                continue
+            column = self.SETS[set_name]
+            deltas.setdefault(client, {"tx_bytes": 0, "rx_bytes": 0})[column] += delta
+        return deltas
+    
+    async def _read_nft_counters(self) -> Dict[Tuple[str, str], int]:
+        """一次性导出整张表，解析两个集合中每个元素的字节计数
+        
+        Returns:
+            (客户端IP, 集合名) -> 字节数
+        """
+        proc = await asyncio.create_subprocess_exec(
+            "nft", "-j", "list", "table", self.NFT_FAMILY, self.NFT_TABLE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=5)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise
+        
+        if proc.returncode != 0:
+            raise Exception(f"nft命令失败: {stderr.decode(errors='replace')}")
+        
+        return self.parse_nft_json(stdout.decode(errors="replace"))
+    
+    @classmethod
+    def parse_nft_json(cls, output: str) -> Dict[Tuple[str, str], int]:
+        """解析 nft -j list table 的输出
+        
+        元素格式: {"elem": {"val": "192.168.9.10", "counter": {"packets": 1, "bytes": 60}}}
+        """
+        counters = {}
+        for item in json.loads(output).get("nftables", []):
+            nft_set = item.get("set")
+            if not nft_set or nft_set.get("name") not in cls.SETS:
+                continue
+            for elem in nft_set.get("elem", []):
+                if not isinstance(elem, dict) or "elem" not in elem:
+                    continue
+                value = elem["elem"]
+                counter = value.get("counter")
+                if counter is None:
+                    continue
+                counters[(str(value["val"]), nft_set["name"])] = int(counter.get("bytes", 0))
+        return counters
+    
+    @classmethod
+    def ruleset(cls, subnet: str) -> str:
+        """生成nftables规则（重复执行时先删除旧表，计数器随之清零）"""
+        return f"""
+table {cls.NFT_FAMILY} {cls.NFT_TABLE}
+delete table {cls.NFT_FAMILY} {cls.NFT_TABLE}
+table {cls.NFT_FAMILY} {cls.NFT_TABLE} {{
+    set client_tx {{
+        type ipv4_addr
+        size {cls.SET_SIZE}
+        flags dynamic
+    }}
+    set client_rx {{
+        type ipv4_addr
+        size {cls.SET_SIZE}
+        flags dynamic
+    }}
+    chain prerouting {{
+        type filter hook prerouting priority -150; policy accept;
+        ip saddr {subnet} ip daddr != {subnet} update @client_tx {{ ip saddr counter }}
+    }}
+    chain postrouting {{
+        type filter hook postrouting priority 150; policy accept;
+        ip daddr {subnet} ip saddr != {subnet} update @client_rx {{ ip daddr counter }}
+    }}
+}}
+"""
+    
+    @classmethod
+    async def setup_nftables_rules(cls):
+        """设置nftables客户端统计规则（容器启动时调用）"""
+        if not cls.is_enabled():
+            return
+        try:
+            logger.info("正在设置nftables客户端统计规则...")
+            proc = await asyncio.create_subprocess_exec(
+                "nft", "-f", "-",
+                stdin=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            _, stderr = await proc.communicate(cls.ruleset(cls.client_subnet()).encode())
+            if proc.returncode != 0:
+                raise Exception(f"nft命令失败: {stderr.decode(errors='replace')}")
+            logger.info("nftables客户端统计规则设置完成")
+        except Exception as e:
+            logger.error(f"设置nftables规则失败: {e}")
+            raise
@@ -0,0 +1,370 @@
+"""
+配置管理模块
+由模板和密钥渲染sing-box配置，校验、比对后以影响最小的方式生效
+"""
+
+import asyncio
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ConfigError(Exception):
+    """配置渲染、校验或生效失败"""
+
+class ConfigBusyError(ConfigError):
+    """另一个配置变更正在进行"""
+
+class ConfigManager:
+    """sing-box配置管理器
+    
+    流程：渲染(render) -> 校验(validate) -> 比对(diff) -> 生效(apply) -> 确认(verify)
+    
+    生效方式按影响从小到大选择：
+    - noop: 配置和规则集都没有变化
+    - rule_set: 只有本地规则集文件变化，原子写入文件，sing-box自动重新加载
+    - reload: 配置有变化，替换运行配置后发送SIGHUP，sing-box在进程内重载
+    重载后sing-box未能保持运行时，自动回滚到上一份配置。
+    """
+    
+    TEMPLATE_FILE = "/app/config/config.json.template"
+    SECRETS_FILE = "/var/lib/sing-box/secrets.json"
+    # 渲染并生效过的配置（持久化，容器重启后entrypoint.sh优先使用）
+    RENDERED_FILE = "/var/lib/sing-box/config.rendered.json"
+    # sing-box实际运行的配置（entrypoint.sh启动时生成）
+    RUNNING_FILE = "/run/sing-box/config.json"
+    LOCK_FILE = "/run/sing-box/config.lock"
+    
+    # 模板中未替换的占位符前缀
+    PLACEHOLDER_PREFIX = "REPLACE_WITH_"
+    
+    # 与supervisord中sing-box的环境变量保持一致，否则check会因废弃字段失败
+    SING_BOX_ENV = {
+        "ENABLE_DEPRECATED_SPECIAL_OUTBOUNDS": "true",
+        "ENABLE_DEPRECATED_TUN_ADDRESS_X": "true",
+        "ENABLE_DEPRECATED_WIREGUARD_OUTBOUND": "true",
+    }
+    
+    # 重载后确认sing-box仍在运行前的等待时间（秒）
+    VERIFY_DELAY = 2
+    
+    # supervisorctl命令的超时（秒）
+    SUPERVISORCTL_TIMEOUT = 10
+    
+    # diff中最多列出的路径数
+    MAX_DIFF_PATHS = 100
+    
+    def __init__(self):
+        self.template_file = Path(self.TEMPLATE_FILE)
+        self.secrets_file = Path(self.SECRETS_FILE)
+        self.rendered_file = Path(self.RENDERED_FILE)
+        self.running_file = Path(self.RUNNING_FILE)
+        self.lock = asyncio.Lock()
+        self.last_result: Optional[Dict] = None
+    
+    # ==================== 渲染 ====================
+    
+    def render(self) -> Dict:
+        """用密钥文件填充模板，返回候选配置
+        
+        密钥文件格式: {"outbounds": {"wg-us": {"private_key": "...", "peer_public_key": "..."}}}
+        """
+        try:
+            config = json.loads(self.template_file.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            raise ConfigError(f"配置模板不存在: {self.template_file}")
+        
+        secrets = {}
+        if self.secrets_file.exists():
+            secrets = json.loads(self.secrets_file.read_text(encoding="utf-8"))
+        
+        for outbound in config.get("outbounds", []):
+            outbound.update(secrets.get("outbounds", {}).get(outbound.get("tag"), {}))
+        
+        unresolved = self._find_placeholders(config)
+        if unresolved:
+            raise ConfigError(f"模板中仍有未替换的占位符: {', '.join(unresolved)}")
+        return config
+    
+    @classmethod
+    def _find_placeholders(cls, value: Any, path: str = "") -> List[str]:
+        """查找未替换的占位符，返回所在路径"""
+        if isinstance(value, str):
+            return [path] if value.startswith(cls.PLACEHOLDER_PREFIX) else []
+        if isinstance(value, dict):
+            return [p for k, v in value.items() for p in cls._find_placeholders(v, f"{path}.{k}")]
+        if isinstance(value, list):
+            return [p for i, v in enumerate(value) for p in cls._find_placeholders(v, f"{path}[{cls._item_key(v, i)}]")]
+        return []
+    
+    # ==================== 校验 ====================
+    
+    async def validate(self, config: Dict):
+        """用 sing-box check 校验候选配置"""
+        candidate = self.running_file.with_name("config.candidate.json")
+        self._write_atomic(candidate, config)
+        proc = await asyncio.create_subprocess_exec(
+            "sing-box", "check", "-c", str(candidate),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env={**os.environ, **self.SING_BOX_ENV}
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=30)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise ConfigError("sing-box check 超时")
+        
+        if proc.returncode != 0:
+            message = (stderr or stdout).decode(errors="replace").strip()
+            raise ConfigError(f"配置校验失败: {message}")
+    
+    # ==================== 比对 ====================
+    
+    def load_running(self) -> Optional[Dict]:
+        """读取正在运行的配置"""
+        try:
+            return json.loads(self.running_file.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+    
+    @classmethod
+    def diff(cls, old: Any, new: Any, path: str = "") -> List[str]:
+        """比较两份配置，返回变化的路径（不包含值，避免泄露密钥）
+        
+        带tag的对象列表（inbounds/outbounds/rule_set等）按tag对齐，顺序变化视为变化。
+        """
+        if type(old) is not type(new):
+            return [path or "."]
+        if isinstance(old, dict):
+            changed = []
+            for key in sorted(set(old) | set(new)):
+                sub = f"{path}.{key}"
+                if key not in old or key not in new:
+                    changed.append(sub)
+                else:
+                    changed.extend(cls.diff(old[key], new[key], sub))
+            return changed
+        if isinstance(old, list):
+            old_keys = [cls._item_key(v, i) for i, v in enumerate(old)]
+            new_keys = [cls._item_key(v, i) for i, v in enumerate(new)]
+            if old_keys != new_keys:
+                return [path]
+            changed = []
+            for key, a, b in zip(new_keys, old, new):
+                changed.extend(cls.diff(a, b, f"{path}[{key}]"))
+            return changed
+        return [] if old == new else [path]
+    
+    @staticmethod
+    def _item_key(value: Any, index: int):
+        """列表元素的对齐键：有tag用tag，否则用下标"""
+        if isinstance(value, dict) and "tag" in value:
+            return value["tag"]
+        return index
+    
+    def rule_set_changes(self, config: Dict, rule_sets: Dict[str, Dict]) -> Dict[Path, Dict]:
+        """找出内容有变化的本地规则集文件
+        
+        Args:
+            config: 候选配置（用于查找规则集tag对应的文件路径）
+            rule_sets: 规则集tag -> 新内容
+        
+        Returns:
+            文件路径 -> 新内容
+        """
+        local = {
+            item["tag"]: Path(item["path"])
+            for item in config.get("route", {}).get("rule_set", [])
+            if item.get("type") == "local" and "path" in item
+        }
+        changes = {}
+        for tag, content in rule_sets.items():
+            if tag not in local:
+                raise ConfigError(f"未找到本地规则集: {tag}")
+            if not isinstance(content, dict) or "rules" not in content:
+                raise ConfigError(f"规则集格式不正确: {tag}")
+            try:
+                current = json.loads(local[tag].read_text(encoding="utf-8"))
+            except (FileNotFoundError, json.JSONDecodeError):
+                current = None
+            if current != content:
+                changes[local[tag]] = content
+        return changes
+    
+    # ==================== 生效 ====================
+    
+    async def apply(self, rule_sets: Optional[Dict[str, Dict]] = None,
+                    dry_run: bool = False) -> Dict:
+        """执行完整的配置变更流程
+        
+        Args:
+            rule_sets: 要同时更新的本地规则集（tag -> 内容）
+            dry_run: 只渲染、校验和比对，不生效
+        
+        Returns:
+            结果，包含mode、变化路径和各阶段耗时（毫秒）
+        """
+        if self.lock.locked():
+            raise ConfigBusyError("另一个配置变更正在进行")
+        
+        async with self.lock:
+            with self._process_lock():
+                timings: Dict[str, float] = {}
+                result = {"time": datetime.now().isoformat(), "dry_run": dry_run, "timings": timings}
+                try:
+                    await self._run_pipeline(rule_sets or {}, dry_run, result, timings)
+                    result["success"] = True
+                except Exception as e:
+                    result["success"] = False
+                    result["error"] = str(e)
+                    raise
+                finally:
+                    self.last_result = result
+                    logger.info(f"配置变更: {result}")
+                return result
+    
+    async def _run_pipeline(self, rule_sets: Dict[str, Dict], dry_run: bool,
+                            result: Dict, timings: Dict[str, float]):
+        """渲染、校验、比对并生效"""
+        with self._timed(timings, "render"):
+            candidate = await asyncio.to_thread(self.render)
+        
+        # 在比对前校验，不合法的配置不会进入生效阶段
+        with self._timed(timings, "validate"):
+            await self.validate(candidate)
+        
+        with self._timed(timings, "diff"):
+            running = self.load_running()
+            changed = self.diff(running, candidate) if running is not None else ["."]
+            files = self.rule_set_changes(candidate, rule_sets)
+        result["changed_paths"] = changed[:self.MAX_DIFF_PATHS]
+        result["changed_rule_sets"] = [str(p) for p in files]
+        
+        if changed:
+            result["mode"] = "reload"
+        elif files:
+            result["mode"] = "rule_set"
+        else:
+            result["mode"] = "noop"
+        
+        if dry_run or result["mode"] == "noop":
+            return
+        
+        with self._timed(timings, "apply"):
+            for path, content in files.items():
+                self._write_atomic(path, content)
+            if result["mode"] == "reload":
+                # 保存原文件内容，生效失败时原样恢复，避免之后的比对误报noop、重启时加载未生效的配置
+                previous = {path: self._read_bytes(path) for path in (self.running_file, self.rendered_file)}
+                self._write_atomic(self.running_file, candidate)
+                self._write_atomic(self.rendered_file, candidate)
+                try:
+                    await self._signal_reload()
+                except BaseException:
+                    self._restore(previous)
+                    raise
+        
+        if result["mode"] == "reload":
+            with self._timed(timings, "verify"):
+                if not await self._verify_running():
+                    self._restore(previous)
+                    result["rolled_back"] = previous[self.running_file] is not None
+                    if result["rolled_back"]:
+                        # sing-box已不在运行，无法接收HUP，用上一份配置重新启动
+                        await self._supervisorctl("restart", "sing-box")
+                        raise ConfigError("重载后sing-box未保持运行，已回滚到上一份配置并重启")
+                    raise ConfigError("重载后sing-box未保持运行，没有可回滚的配置")
+    
+    async def _signal_reload(self):
+        """通知sing-box重新加载配置（SIGHUP，进程内重载）"""
+        await self._supervisorctl("signal", "HUP", "sing-box")
+    
+    async def _verify_running(self) -> bool:
+        """确认sing-box在重载后仍在运行"""
+        await asyncio.sleep(self.VERIFY_DELAY)
+        output = await self._supervisorctl("status", "sing-box", check=False)
+        return "RUNNING" in output
+    
+    async def _supervisorctl(self, *args: str, check: bool = True) -> str:
+        """执行supervisorctl命令"""
+        proc = await asyncio.create_subprocess_exec(
+            "supervisorctl", *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=self.SUPERVISORCTL_TIMEOUT)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise ConfigError(f"supervisorctl {' '.join(args)} 超时")
+        output = stdout.decode(errors="replace")
+        if check and proc.returncode != 0:
+            raise ConfigError(f"supervisorctl {' '.join(args)} 失败: {output.strip()}")
+        return output
+    
+    # ==================== 工具 ====================
+    
+    @staticmethod
+    def _read_bytes(path: Path) -> Optional[bytes]:
+        """读取文件原始内容，不存在时返回None"""
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+    
+    @staticmethod
+    def _restore(snapshot: Dict[Path, Optional[bytes]]):
+        """把文件恢复为_read_bytes保存的内容（原来不存在的文件删除）"""
+        for path, data in snapshot.items():
+            if data is None:
+                path.unlink(missing_ok=True)
+                continue
+            tmp = path.with_name(f".{path.name}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+    
+    @staticmethod
+    def _write_atomic(path: Path, content: Dict):
+        """写入临时文件后改名，读者不会看到写了一半的文件"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(content, f, indent=2, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    
+    @staticmethod
+    @contextmanager
+    def _timed(timings: Dict[str, float], name: str):
+        """记录一个阶段的耗时（毫秒）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[name] = round((time.perf_counter() - start) * 1000, 2)
+    
+    @contextmanager
+    def _process_lock(self):
+        """跨worker的配置变更锁（非阻塞，被占用时抛出ConfigBusyError）"""
+        path = Path(self.LOCK_FILE)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise ConfigBusyError("另一个配置变更正在进行")
+            yield
+        finally:
+            os.close(fd)
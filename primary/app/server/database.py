@@ -3,25 +3,56 @@
 使用SQLite存储流量统计数据
 """
 
+import asyncio
 import aiosqlite
-from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+import sqlite3
+import time
+from datetime import date, datetime, timedelta
+from typing import AsyncIterator, List, Dict, Optional
 import logging
 
+from .rate_sketch import RateHistogram, dump_sketches, load_sketches
+
 logger = logging.getLogger(__name__)
 
+# 各线路在快照表中的字节列和在统计表中的列前缀
+LINES = {"direct": "direct_bytes", "us": "us_bytes", "sg": "sg_bytes"}
+
 class Database:
     """数据库管理类"""
     
+    # 多进程访问时等待写锁的超时（秒）
+    BUSY_TIMEOUT = 5.0
+    
+    # 导出时各精度对应的表和列
+    EXPORT_SOURCES = {
+        "snapshot": ("traffic_snapshots", "timestamp",
+                     ["timestamp", "direct_bytes", "us_bytes", "sg_bytes", "interval_seconds", "gap"]),
+        "hourly": ("hourly_stats", "hour",
+                   ["hour", "direct_total", "us_total", "sg_total"]),
+        "daily": ("daily_stats", "date",
+                  ["date", "direct_total", "us_total", "sg_total"]),
+    }
+    
+    # 分批删除时每批的行数（每批单独提交，避免长时间持有写锁）
+    CLEANUP_CHUNK_SIZE = 500
+    
     def __init__(self, db_path: str = "/var/lib/sing-box/traffic.db"):
         self.db_path = db_path
         self.conn: Optional[aiosqlite.Connection] = None
     
     async def init_db(self):
         """初始化数据库"""
-        self.conn = await aiosqlite.connect(self.db_path)
+        self.conn = await aiosqlite.connect(self.db_path, timeout=self.BUSY_TIMEOUT)
         self.conn.row_factory = aiosqlite.Row
         
+        # 增量回收空闲页（仅对新建的空库直接生效，旧库由保留策略转换）
+        await self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        
+        # WAL模式：多个worker进程读取时不会被采集写入阻塞
+        await self.conn.execute("PRAGMA journal_mode=WAL")
+        await self.conn.execute("PRAGMA synchronous=NORMAL")
+        
         # 创建表
         await self.conn.executescript("""
             -- 实时快照表（每分钟一条，保留24小时）
@@ -30,7 +61,20 @@ class Database:
                 timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
                 direct_bytes INTEGER DEFAULT 0,
                 us_bytes INTEGER DEFAULT 0,
-                sg_bytes INTEGER DEFAULT 0
+                sg_bytes INTEGER DEFAULT 0,
+                interval_seconds REAL DEFAULT 60,
+                gap INTEGER DEFAULT 0
+            );
+            
+            -- 采集检查点（单行，记录上一次的计数器基线和采样时间）
+            CREATE TABLE IF NOT EXISTS collector_checkpoint (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                sample_ts REAL NOT NULL,
+                total_bytes INTEGER DEFAULT 0,
+                us_bytes INTEGER DEFAULT 0,
+                sg_bytes INTEGER DEFAULT 0,
+                direct_bytes INTEGER DEFAULT 0,
+                chain_epoch TEXT
             );
             
             -- 小时统计表（每小时一条，保留7天）
@@ -51,15 +95,96 @@ class Database:
                 sg_total INTEGER DEFAULT 0
             );
             
+            -- DNS查询小时统计（来自sing-box日志）
+            CREATE TABLE IF NOT EXISTS dns_hourly (
+                hour DATETIME NOT NULL,
+                domain TEXT NOT NULL,
+                queries INTEGER DEFAULT 0,
+                cache_misses INTEGER DEFAULT 0,
+                PRIMARY KEY (hour, domain)
+            );
+            
+            -- 出站选择小时统计（来自sing-box日志）
+            CREATE TABLE IF NOT EXISTS route_hourly (
+                hour DATETIME NOT NULL,
+                domain TEXT NOT NULL,
+                outbound TEXT NOT NULL,
+                connections INTEGER DEFAULT 0,
+                PRIMARY KEY (hour, domain, outbound)
+            );
+            
+            -- 客户端小时流量（nftables客户端统计模式）
+            CREATE TABLE IF NOT EXISTS client_hourly (
+                hour DATETIME NOT NULL,
+                client_ip TEXT NOT NULL,
+                tx_bytes INTEGER DEFAULT 0,
+                rx_bytes INTEGER DEFAULT 0,
+                PRIMARY KEY (hour, client_ip)
+            );
+            
+            -- 客户端计数器基线
+            CREATE TABLE IF NOT EXISTS client_counters (
+                client_ip TEXT NOT NULL,
+                set_name TEXT NOT NULL,
+                bytes INTEGER DEFAULT 0,
+                PRIMARY KEY (client_ip, set_name)
+            );
+            
+            -- 客户端基线已建立的标记（集合为空时client_counters也为空，不能据此判断）
+            CREATE TABLE IF NOT EXISTS client_checkpoint (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                saved_at REAL NOT NULL
+            );
+            
+            -- 日志采集断点
+            CREATE TABLE IF NOT EXISTS log_ingest_state (
+                path TEXT PRIMARY KEY,
+                inode INTEGER,
+                offset INTEGER DEFAULT 0,
+                updated_at DATETIME
+            );
+            
             -- 创建索引
             CREATE INDEX IF NOT EXISTS idx_snapshots_timestamp ON traffic_snapshots(timestamp);
             CREATE INDEX IF NOT EXISTS idx_hourly_hour ON hourly_stats(hour);
             CREATE INDEX IF NOT EXISTS idx_daily_date ON daily_stats(date);
         """)
         
-        await self.conn.commit()
+        await self._migrate()
         logger.info("数据库表创建完成")
     
+    async def _migrate(self):
+        """旧版本数据库升级：补充各表新增的列
+        
+        多worker同时启动时都会执行升级，检查列和添加列放在同一个
+        BEGIN IMMEDIATE事务中，先拿到写锁的worker完成升级，其余worker等锁后看到的已是新表结构。
+        """
+        await self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            await self._ensure_column("traffic_snapshots", "interval_seconds", "REAL DEFAULT 60")
+            await self._ensure_column("traffic_snapshots", "gap", "INTEGER DEFAULT 0")
+            # 速率分布（字节/秒，峰值即直方图的max）
+            for table in ("hourly_stats", "daily_stats"):
+                await self._ensure_column(table, "rate_sketch", "TEXT")
+            await self.conn.commit()
+        except BaseException:
+            await self.conn.rollback()
+            raise
+    
+    async def _ensure_column(self, table: str, column: str, definition: str):
+        """表中缺少指定列时自动添加"""
+        cursor = await self.conn.execute(f"PRAGMA table_info({table})")
+        columns = [row["name"] for row in await cursor.fetchall()]
+        if column not in columns:
+            try:
+                await self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            except sqlite3.OperationalError as e:
+                # 其他进程已经添加了该列
+                if "duplicate column name" not in str(e):
+                    raise
+                return
+            logger.info(f"数据库升级: {table} 添加列 {column}")
+    
     async def close(self):
         """关闭数据库连接"""
         if self.conn:
@@ -67,13 +192,61 @@ class Database:
     
     # ==================== 快照操作 ====================
     
-    async def save_snapshot(self, direct_bytes: int, us_bytes: int, sg_bytes: int):
-        """保存流量快照"""
-        await self.conn.execute("""
-            INSERT INTO traffic_snapshots (timestamp, direct_bytes, us_bytes, sg_bytes)
-            VALUES (?, ?, ?, ?)
-        """, (datetime.now(), direct_bytes, us_bytes, sg_bytes))
-        await self.conn.commit()
+    async def save_samples(self, samples: List[Dict], checkpoint: Dict):
+        """在同一事务中写入快照和采集检查点
+        
+        快照与计数器基线要么一起落盘，要么都不落盘，
+        避免进程中途退出后重复计入或丢失一段流量。
+        
+        Args:
+            samples: 快照列表，每项包含timestamp、direct_bytes、us_bytes、
+                     sg_bytes、interval_seconds、gap
+            checkpoint: 新的计数器基线，包含sample_ts、total_bytes、us_bytes、
+                        sg_bytes、direct_bytes、chain_epoch
+        """
+        try:
+            if samples:
+                await self.conn.executemany("""
+                    INSERT INTO traffic_snapshots
+                        (timestamp, direct_bytes, us_bytes, sg_bytes, interval_seconds, gap)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, [
+                    (s["timestamp"], s["direct_bytes"], s["us_bytes"], s["sg_bytes"],
+                     s["interval_seconds"], 1 if s["gap"] else 0)
+                    for s in samples
+                ])
+            
+            await self.conn.execute("""
+                INSERT INTO collector_checkpoint
+                    (id, sample_ts, total_bytes, us_bytes, sg_bytes, direct_bytes, chain_epoch)
+                VALUES (1, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    sample_ts = excluded.sample_ts,
+                    total_bytes = excluded.total_bytes,
+                    us_bytes = excluded.us_bytes,
+                    sg_bytes = excluded.sg_bytes,
+                    direct_bytes = excluded.direct_bytes,
+                    chain_epoch = excluded.chain_epoch
+            """, (
+                checkpoint["sample_ts"], checkpoint["total_bytes"], checkpoint["us_bytes"],
+                checkpoint["sg_bytes"], checkpoint["direct_bytes"], checkpoint["chain_epoch"]
+            ))
+            await self.conn.commit()
+        except Exception:
+            await self.conn.rollback()
+            raise
+    
+    async def get_collector_checkpoint(self) -> Optional[Dict]:
+        """获取采集检查点（不存在时返回None）"""
+        cursor = await self.conn.execute("""
+            SELECT sample_ts, total_bytes, us_bytes, sg_bytes, direct_bytes, chain_epoch
+            FROM collector_checkpoint
+            WHERE id = 1
+        """)
+        row = await cursor.fetchone()
+        if row:
+            return dict(row)
+        return None
     
     async def get_latest_snapshot(self) -> Optional[Dict]:
         """获取最新的流量快照"""
@@ -88,21 +261,92 @@ class Database:
             return dict(row)
         return None
     
-    async def cleanup_old_snapshots(self, hours: int = 24):
+    async def cleanup_old_snapshots(self, hours: int = 24) -> int:
         """清理旧的快照数据"""
         cutoff_time = datetime.now() - timedelta(hours=hours)
-        await self.conn.execute("""
-            DELETE FROM traffic_snapshots
-            WHERE timestamp < ?
-        """, (cutoff_time,))
-        await self.conn.commit()
-        logger.info(f"清理了{hours}小时前的快照数据")
+        deleted = await self._delete_in_chunks("traffic_snapshots", "timestamp", cutoff_time)
+        logger.info(f"清理了{hours}小时前的快照数据: {deleted}条")
+        return deleted
+    
+    async def compact_snapshots(self, before: datetime, bucket_seconds: int) -> int:
+        """把指定时间之前的快照合并为更粗的时间桶（降采样）
+        
+        同一桶内的快照合并为一条，字节数和时长相加，断档标记取并集，
+        时间戳取桶内最后一条，因此合并后仍落在原来的小时内，小时汇总不变。
+        
+        Args:
+            before: 只处理该时间之前的快照
+            bucket_seconds: 桶宽度（秒）
+        
+        Returns:
+            减少的行数
+        """
+        removed = 0
+        while True:
+            cursor = await self.conn.execute("""
+                SELECT id, timestamp, direct_bytes, us_bytes, sg_bytes, interval_seconds, gap
+                FROM traffic_snapshots
+                WHERE timestamp < ? AND COALESCE(interval_seconds, 60) < ?
+                ORDER BY timestamp ASC
+                LIMIT ?
+            """, (before, bucket_seconds, self.CLEANUP_CHUNK_SIZE))
+            rows = await cursor.fetchall()
+            if not rows:
+                break
+            
+            buckets: Dict[int, List] = {}
+            for row in rows:
+                ts = datetime.fromisoformat(str(row["timestamp"]))
+                buckets.setdefault(int(ts.timestamp()) // bucket_seconds, []).append((ts, row))
+            
+            # 最后一个桶可能被LIMIT截断，除非本批已是全部数据，否则留到下一批
+            if len(rows) == self.CLEANUP_CHUNK_SIZE and len(buckets) > 1:
+                buckets.pop(max(buckets))
+            
+            merged = []
+            ids = []
+            for items in buckets.values():
+                merged.append((
+                    max(ts for ts, _ in items),
+                    sum(row["direct_bytes"] for _, row in items),
+                    sum(row["us_bytes"] for _, row in items),
+                    sum(row["sg_bytes"] for _, row in items),
+                    # 合并后的时长至少为一个桶宽，避免被再次选中
+                    max(bucket_seconds, sum(row["interval_seconds"] or 60 for _, row in items)),
+                    max(row["gap"] or 0 for _, row in items)
+                ))
+                ids.extend(row["id"] for _, row in items)
+            
+            try:
+                await self.conn.executemany(
+                    "DELETE FROM traffic_snapshots WHERE id = ?", [(i,) for i in ids]
+                )
+                await self.conn.executemany("""
+                    INSERT INTO traffic_snapshots
+                        (timestamp, direct_bytes, us_bytes, sg_bytes, interval_seconds, gap)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, merged)
+                await self.conn.commit()
+            except Exception:
+                await self.conn.rollback()
+                raise
+            
+            removed += len(ids) - len(merged)
+            await asyncio.sleep(0)
+        
+        return removed
     
     # ==================== 小时统计操作 ====================
     
-    async def update_hourly_stats(self):
-        """更新小时统计（聚合最近一小时的快照数据）"""
-        current_hour = datetime.now().replace(minute=0, second=0, microsecond=0)
+    async def update_hourly_stats(self, hour: Optional[datetime] = None):
+        """更新小时统计（聚合指定小时的快照数据）
+        
+        可重复执行：每次都由该小时的全部快照重新计算。
+        
+        Args:
+            hour: 要汇总的小时，默认当前小时
+        """
+        current_hour = (hour or datetime.now()).replace(minute=0, second=0, microsecond=0)
         
         # 聚合最近一小时的数据
         cursor = await self.conn.execute("""
@@ -116,17 +360,37 @@ class Database:
         
         row = await cursor.fetchone()
         if row:
+            sketches = await self._snapshot_rate_sketches(current_hour, current_hour + timedelta(hours=1))
+            
             # 插入或更新小时统计
             await self.conn.execute("""
-                INSERT INTO hourly_stats (hour, direct_total, us_total, sg_total)
-                VALUES (?, ?, ?, ?)
+                INSERT INTO hourly_stats (hour, direct_total, us_total, sg_total, rate_sketch)
+                VALUES (?, ?, ?, ?, ?)
                 ON CONFLICT(hour) DO UPDATE SET
                     direct_total = excluded.direct_total,
                     us_total = excluded.us_total,
-                    sg_total = excluded.sg_total
-            """, (current_hour, row["direct_total"], row["us_total"], row["sg_total"]))
+                    sg_total = excluded.sg_total,
+                    rate_sketch = excluded.rate_sketch
+            """, (current_hour, row["direct_total"], row["us_total"], row["sg_total"],
+                  dump_sketches(sketches)))
             await self.conn.commit()
-            logger.info(f"更新小时统计: {current_hour}")
+            logger.debug(f"更新小时统计: {current_hour}")
+    
+    async def _snapshot_rate_sketches(self, start: datetime, end: datetime) -> Dict[str, RateHistogram]:
+        """由时间范围内的快照构建各线路的速率直方图（每个快照一个速率样本）"""
+        cursor = await self.conn.execute("""
+            SELECT direct_bytes, us_bytes, sg_bytes, interval_seconds
+            FROM traffic_snapshots
+            WHERE timestamp >= ? AND timestamp < ?
+        """, (start, end))
+        rows = await cursor.fetchall()
+        
+        sketches = {line: RateHistogram() for line in LINES}
+        for row in rows:
+            interval = row["interval_seconds"] or 60
+            for line, column in LINES.items():
+                sketches[line].add((row[column] or 0) / interval)
+        return sketches
     
     async def get_hourly_stats(self, hours: int = 24) -> List[Dict]:
         """获取最近N小时的统计数据"""
@@ -140,21 +404,54 @@ class Database:
         rows = await cursor.fetchall()
         return [dict(row) for row in rows]
     
-    async def cleanup_old_hourly_stats(self, days: int = 7):
-        """清理旧的小时统计"""
-        cutoff_time = datetime.now() - timedelta(days=days)
-        await self.conn.execute("""
-            DELETE FROM hourly_stats
+    async def cleanup_old_hourly_stats(self, days: int = 7) -> int:
+        """清理旧的小时统计（按整天删除，见_day_start）"""
+        cutoff_time = self._day_start(datetime.now() - timedelta(days=days))
+        deleted = await self._delete_in_chunks("hourly_stats", "hour", cutoff_time)
+        logger.info(f"清理了{days}天前的小时统计: {deleted}条")
+        return deleted
+    
+    async def downsample_hourly_stats(self, before: datetime) -> int:
+        """把指定时间之前的整天小时统计折叠进日统计后删除
+        
+        截止时间向下取整到当天零点：日统计由当天全部小时重新汇总，
+        若只删掉某天的一部分小时，下次汇总会用剩余小时覆盖正确的日统计。
+        
+        Returns:
+            删除的行数
+        """
+        before = self._day_start(before)
+        cursor = await self.conn.execute("""
+            SELECT DISTINCT DATE(hour) AS day
+            FROM hourly_stats
             WHERE hour < ?
-        """, (cutoff_time,))
-        await self.conn.commit()
-        logger.info(f"清理了{days}天前的小时统计")
+        """, (before,))
+        days = [row["day"] for row in await cursor.fetchall()]
+        
+        # 先确保这些天的日统计已包含小时数据
+        for day in days:
+            await self.update_daily_stats(day=date.fromisoformat(day))
+        
+        return await self._delete_in_chunks("hourly_stats", "hour", before)
+    
+    @staticmethod
+    def _day_start(moment: datetime) -> datetime:
+        """当天零点（本地时间）
+        
+        小时统计只按整天删除，保证仍有小时数据的日期都是完整的一天，
+        重新汇总日统计时不会丢失已删除小时的流量和速率分布。
+        """
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
     
     # ==================== 日统计操作 ====================
     
-    async def update_daily_stats(self):
-        """更新日统计（聚合当天的小时统计）"""
-        today = datetime.now().date()
+    async def update_daily_stats(self, day: Optional[date] = None):
+        """更新日统计（聚合指定日期的小时统计）
+        
+        Args:
+            day: 要汇总的日期，默认当天
+        """
+        today = day or datetime.now().date()
         
         # 聚合当天的小时统计
         cursor = await self.conn.execute("""
@@ -168,17 +465,29 @@ class Database:
         
         row = await cursor.fetchone()
         if row:
+            # 合并当天各小时的速率直方图
+            cursor = await self.conn.execute("""
+                SELECT rate_sketch FROM hourly_stats WHERE DATE(hour) = ?
+            """, (today,))
+            sketches = {line: RateHistogram() for line in LINES}
+            for hourly in await cursor.fetchall():
+                for line, hist in load_sketches(hourly["rate_sketch"]).items():
+                    if line in sketches:
+                        sketches[line].merge(hist)
+            
             # 插入或更新日统计
             await self.conn.execute("""
-                INSERT INTO daily_stats (date, direct_total, us_total, sg_total)
-                VALUES (?, ?, ?, ?)
+                INSERT INTO daily_stats (date, direct_total, us_total, sg_total, rate_sketch)
+                VALUES (?, ?, ?, ?, ?)
                 ON CONFLICT(date) DO UPDATE SET
                     direct_total = excluded.direct_total,
                     us_total = excluded.us_total,
-                    sg_total = excluded.sg_total
-            """, (today, row["direct_total"], row["us_total"], row["sg_total"]))
+                    sg_total = excluded.sg_total,
+                    rate_sketch = excluded.rate_sketch
+            """, (today, row["direct_total"], row["us_total"], row["sg_total"],
+                  dump_sketches(sketches)))
             await self.conn.commit()
-            logger.info(f"更新日统计: {today}")
+            logger.debug(f"更新日统计: {today}")
     
     async def get_daily_stats(self, days: int = 30) -> List[Dict]:
         """获取最近N天的统计数据"""
@@ -192,12 +501,379 @@ class Database:
         rows = await cursor.fetchall()
         return [dict(row) for row in rows]
     
-    async def cleanup_old_daily_stats(self, days: int = 90):
+    # ==================== 速率统计 ====================
+    
+    async def get_rate_sketches(self, resolution: str, count: int) -> List[Dict]:
+        """获取最近N个小时/天的速率直方图
+        
+        Args:
+            resolution: hourly 或 daily
+            count: 小时数或天数
+        
+        Returns:
+            [{"time": .., "sketches": {线路: RateHistogram}}]
+        """
+        if resolution == "hourly":
+            column, table = "hour", "hourly_stats"
+            cutoff = datetime.now() - timedelta(hours=count)
+        else:
+            column, table = "date", "daily_stats"
+            cutoff = datetime.now().date() - timedelta(days=count)
+        
+        cursor = await self.conn.execute(f"""
+            SELECT {column} AS time, rate_sketch
+            FROM {table}
+            WHERE {column} >= ?
+            ORDER BY {column} ASC
+        """, (cutoff,))
+        rows = await cursor.fetchall()
+        return [{"time": row["time"], "sketches": load_sketches(row["rate_sketch"])} for row in rows]
+    
+    async def cleanup_old_daily_stats(self, days: int = 90) -> int:
         """清理旧的日统计"""
         cutoff_date = datetime.now().date() - timedelta(days=days)
-        await self.conn.execute("""
-            DELETE FROM daily_stats
-            WHERE date < ?
-        """, (cutoff_date,))
+        deleted = await self._delete_in_chunks("daily_stats", "date", cutoff_date)
+        logger.info(f"清理了{days}天前的日统计: {deleted}条")
+        return deleted
+    
+    # ==================== 客户端统计 ====================
+    
+    async def save_client_deltas(self, hour: datetime, deltas: Dict[str, Dict[str, int]],
+                                 counters: Dict[tuple, int]):
+        """在同一事务中累加客户端增量并替换计数器基线
+        
+        Args:
+            hour: 增量所属小时
+            deltas: 客户端IP -> {"tx_bytes": .., "rx_bytes": ..}
+            counters: (客户端IP, 集合名) -> 当前字节数
+        """
+        try:
+            if deltas:
+                await self.conn.executemany("""
+                    INSERT INTO client_hourly (hour, client_ip, tx_bytes, rx_bytes)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(hour, client_ip) DO UPDATE SET
+                        tx_bytes = tx_bytes + excluded.tx_bytes,
+                        rx_bytes = rx_bytes + excluded.rx_bytes
+                """, [
+                    (hour, client, d["tx_bytes"], d["rx_bytes"])
+                    for client, d in deltas.items()
+                ])
+            await self.conn.execute("DELETE FROM client_counters")
+            await self.conn.executemany("""
+                INSERT INTO client_counters (client_ip, set_name, bytes)
+                VALUES (?, ?, ?)
+            """, [(client, set_name, value) for (client, set_name), value in counters.items()])
+            await self.conn.execute("""
+                INSERT INTO client_checkpoint (id, saved_at) VALUES (1, ?)
+                ON CONFLICT(id) DO UPDATE SET saved_at = excluded.saved_at
+            """, (time.time(),))
+            await self.conn.commit()
+        except Exception:
+            await self.conn.rollback()
+            raise
+    
+    async def get_client_baseline(self) -> Optional[Dict[tuple, int]]:
+        """获取客户端计数器基线（从未建立过基线时返回None）"""
+        cursor = await self.conn.execute("""
+            SELECT client_ip, set_name, bytes
+            FROM client_counters
+        """)
+        rows = await cursor.fetchall()
+        baseline = {(row["client_ip"], row["set_name"]): row["bytes"] for row in rows}
+        if baseline:
+            return baseline
+        
+        cursor = await self.conn.execute("SELECT 1 FROM client_checkpoint WHERE id = 1")
+        return baseline if await cursor.fetchone() else None
+    
+    async def get_client_stats(self, hours: int = 24, limit: int = 100) -> List[Dict]:
+        """获取最近N小时各客户端的流量（按总流量降序）"""
+        cutoff = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours - 1)
+        cursor = await self.conn.execute("""
+            SELECT client_ip,
+                   SUM(tx_bytes) AS tx_bytes,
+                   SUM(rx_bytes) AS rx_bytes
+            FROM client_hourly
+            WHERE hour >= ?
+            GROUP BY client_ip
+            ORDER BY SUM(tx_bytes) + SUM(rx_bytes) DESC
+            LIMIT ?
+        """, (cutoff, limit))
+        rows = await cursor.fetchall()
+        return [dict(row) for row in rows]
+    
+    async def cleanup_old_client_stats(self, days: int = 7) -> int:
+        """清理旧的客户端小时流量"""
+        cutoff_time = datetime.now() - timedelta(days=days)
+        deleted = await self._delete_in_chunks("client_hourly", "hour", cutoff_time)
+        logger.info(f"清理了{days}天前的客户端流量: {deleted}条")
+        return deleted
+    
+    # ==================== 日志分析 ====================
+    
+    async def save_log_batch(self, dns_rows: List[tuple], route_rows: List[tuple], state: Dict):
+        """在同一事务中累加一批日志聚合结果并更新采集断点
+        
+        Args:
+            dns_rows: (小时, 域名, 查询数, 未命中数)
+            route_rows: (小时, 域名, 出站, 连接数)
+            state: 断点，包含path、inode、offset
+        """
+        try:
+            if dns_rows:
+                await self.conn.executemany("""
+                    INSERT INTO dns_hourly (hour, domain, queries, cache_misses)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(hour, domain) DO UPDATE SET
+                        queries = queries + excluded.queries,
+                        cache_misses = cache_misses + excluded.cache_misses
+                """, dns_rows)
+            if route_rows:
+                await self.conn.executemany("""
+                    INSERT INTO route_hourly (hour, domain, outbound, connections)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(hour, domain, outbound) DO UPDATE SET
+                        connections = connections + excluded.connections
+                """, route_rows)
+            await self.conn.execute("""
+                INSERT INTO log_ingest_state (path, inode, offset, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    inode = excluded.inode,
+                    offset = excluded.offset,
+                    updated_at = excluded.updated_at
+            """, (state["path"], state["inode"], state["offset"], datetime.now()))
+            await self.conn.commit()
+        except Exception:
+            await self.conn.rollback()
+            raise
+    
+    async def get_log_state(self, path: str) -> Optional[Dict]:
+        """获取日志采集断点（不存在时返回None）"""
+        cursor = await self.conn.execute("""
+            SELECT path, inode, offset
+            FROM log_ingest_state
+            WHERE path = ?
+        """, (path,))
+        row = await cursor.fetchone()
+        if row:
+            return dict(row)
+        return None
+    
+    async def get_log_domains(self, kind: str, hour: str) -> List[str]:
+        """获取某小时已记录的域名
+        
+        Args:
+            kind: dns 或 route
+            hour: 小时（YYYY-MM-DD HH:00:00）
+        """
+        table = "dns_hourly" if kind == "dns" else "route_hourly"
+        cursor = await self.conn.execute(
+            f"SELECT DISTINCT domain FROM {table} WHERE hour = ?", (hour,)
+        )
+        return [row["domain"] for row in await cursor.fetchall()]
+    
+    async def get_dns_stats(self, hours: int = 24, limit: int = 50) -> List[Dict]:
+        """获取最近N小时查询最多的域名"""
+        cutoff = (datetime.now() - timedelta(hours=hours)).strftime("%Y-%m-%d %H:00:00")
+        cursor = await self.conn.execute("""
+            SELECT domain,
+                   SUM(queries) AS queries,
+                   SUM(cache_misses) AS cache_misses
+            FROM dns_hourly
+            WHERE hour >= ?
+            GROUP BY domain
+            ORDER BY queries DESC
+            LIMIT ?
+        """, (cutoff, limit))
+        rows = await cursor.fetchall()
+        return [dict(row) for row in rows]
+    
+    async def get_route_stats(self, hours: int = 24, limit: int = 50) -> Dict:
+        """获取最近N小时各出站的连接数和连接最多的域名"""
+        cutoff = (datetime.now() - timedelta(hours=hours)).strftime("%Y-%m-%d %H:00:00")
+        cursor = await self.conn.execute("""
+            SELECT outbound, SUM(connections) AS connections
+            FROM route_hourly
+            WHERE hour >= ?
+            GROUP BY outbound
+            ORDER BY connections DESC
+        """, (cutoff,))
+        outbounds = [dict(row) for row in await cursor.fetchall()]
+        
+        cursor = await self.conn.execute("""
+            SELECT domain, outbound, SUM(connections) AS connections
+            FROM route_hourly
+            WHERE hour >= ?
+            GROUP BY domain, outbound
+            ORDER BY connections DESC
+            LIMIT ?
+        """, (cutoff, limit))
+        domains = [dict(row) for row in await cursor.fetchall()]
+        return {"outbounds": outbounds, "domains": domains}
+    
+    async def cleanup_old_log_stats(self, days: int = 7) -> int:
+        """清理旧的日志分析统计"""
+        cutoff = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:00:00")
+        deleted = 0
+        for table in ("dns_hourly", "route_hourly"):
+            deleted += await self._delete_in_chunks(table, "hour", cutoff)
+        logger.info(f"清理了{days}天前的日志分析统计: {deleted}条")
+        return deleted
+    
+    async def fold_log_domains(self, before: datetime, keep_top: int,
+                               other_domain: str = "(other)") -> int:
+        """把指定时间之前每小时排名靠后的域名合并为一行（降采样）
+        
+        DNS统计每小时保留查询数最多的keep_top个域名，出站统计每小时每个出站保留
+        连接数最多的keep_top个域名，其余累加到other_domain，总数不变。
+        每个小时单独提交，避免长时间持有写锁。
+        
+        Returns:
+            合并掉的行数
+        """
+        cutoff = before.strftime("%Y-%m-%d %H:00:00")
+        # (表, 排名分组列, 排序列, 累加列)
+        tiers = (
+            ("dns_hourly", "hour", "queries", ("queries", "cache_misses")),
+            ("route_hourly", "hour, outbound", "connections", ("connections",)),
+        )
+        folded = 0
+        for table, group_cols, order, sums in tiers:
+            cursor = await self.conn.execute(f"""
+                SELECT DISTINCT hour FROM {table} WHERE hour < ? ORDER BY hour
+            """, (cutoff,))
+            hours = [row["hour"] for row in await cursor.fetchall()]
+            
+            ranked = f"""
+                SELECT rowid, {group_cols}, {", ".join(sums)},
+                       ROW_NUMBER() OVER (PARTITION BY {group_cols}
+                                          ORDER BY {order} DESC, domain) AS rn
+                FROM {table}
+                WHERE hour = ? AND domain != ?
+            """
+            for hour in hours:
+                try:
+                    await self.conn.execute(f"""
+                        INSERT INTO {table} ({group_cols}, domain, {", ".join(sums)})
+                        SELECT {group_cols}, ?, {", ".join(f"SUM({c})" for c in sums)}
+                        FROM ({ranked})
+                        WHERE rn > ?
+                        GROUP BY {group_cols}
+                        ON CONFLICT DO UPDATE SET
+                            {", ".join(f"{c} = {c} + excluded.{c}" for c in sums)}
+                    """, (other_domain, hour, other_domain, keep_top))
+                    cursor = await self.conn.execute(f"""
+                        DELETE FROM {table} WHERE rowid IN (
+                            SELECT rowid FROM ({ranked}) WHERE rn > ?
+                        )
+                    """, (hour, other_domain, keep_top))
+                    folded += cursor.rowcount
+                    await self.conn.commit()
+                except Exception:
+                    await self.conn.rollback()
+                    raise
+                await asyncio.sleep(0)
+        
+        if folded:
+            logger.info(f"合并了{before}之前的日志分析统计: {folded}条")
+        return folded
+    
+    # ==================== 导出 ====================
+    
+    async def iter_traffic_rows(self, resolution: str, start, end,
+                                batch_size: int = 1000) -> AsyncIterator[List[tuple]]:
+        """按批次流式读取指定时间范围的流量数据
+        
+        使用独立的只读连接：大范围导出不会占用共享连接的请求队列，
+        WAL模式下读取的是一致的快照，也不会阻塞采集写入。
+        
+        Args:
+            resolution: snapshot / hourly / daily
+            start: 起始时间（含）
+            end: 结束时间（不含）
+            batch_size: 每批行数
+        
+        Yields:
+            每批的行（元组列表），列顺序同EXPORT_SOURCES
+        """
+        table, column, columns = self.EXPORT_SOURCES[resolution]
+        async with aiosqlite.connect(f"file:{self.db_path}?mode=ro", uri=True,
+                                     timeout=self.BUSY_TIMEOUT) as conn:
+            cursor = await conn.execute(f"""
+                SELECT {", ".join(columns)}
+                FROM {table}
+                WHERE {column} >= ? AND {column} < ?
+                ORDER BY {column} ASC
+            """, (start, end))
+            while True:
+                rows = await cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+    
+    # ==================== 存储维护 ====================
+    
+    async def _delete_in_chunks(self, table: str, column: str, cutoff) -> int:
+        """分批删除指定列早于cutoff的行
+        
+        每批单独提交并让出事件循环，其他进程的写入可以穿插进行。
+        
+        Returns:
+            删除的总行数
+        """
+        deleted = 0
+        while True:
+            cursor = await self.conn.execute(f"""
+                DELETE FROM {table}
+                WHERE rowid IN (
+                    SELECT rowid FROM {table}
+                    WHERE {column} < ?
+                    LIMIT ?
+                )
+            """, (cutoff, self.CLEANUP_CHUNK_SIZE))
+            await self.conn.commit()
+            deleted += cursor.rowcount
+            if cursor.rowcount < self.CLEANUP_CHUNK_SIZE:
+                break
+            await asyncio.sleep(0)
+        return deleted
+    
+    async def get_storage_info(self) -> Dict:
+        """获取数据库文件占用情况"""
+        info = {}
+        for pragma in ("page_count", "page_size", "freelist_count", "auto_vacuum"):
+            cursor = await self.conn.execute(f"PRAGMA {pragma}")
+            row = await cursor.fetchone()
+            info[pragma] = row[0]
+        info["size_bytes"] = info["page_count"] * info["page_size"]
+        info["used_bytes"] = (info["page_count"] - info["freelist_count"]) * info["page_size"]
+        return info
+    
+    async def enable_incremental_vacuum(self):
+        """把旧库转换为增量回收模式（需要一次完整VACUUM）"""
+        info = await self.get_storage_info()
+        if info["auto_vacuum"] == 2:
+            return
+        logger.info("转换数据库为auto_vacuum=INCREMENTAL，执行一次VACUUM...")
         await self.conn.commit()
-        logger.info(f"清理了{days}天前的日统计")
+        await self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await self.conn.execute("VACUUM")
+        logger.info("数据库转换完成")
+    
+    async def incremental_vacuum(self, pages: int) -> int:
+        """回收最多pages个空闲页
+        
+        Returns:
+            回收的页数
+        """
+        before = (await self.get_storage_info())["freelist_count"]
+        # sqlite3模块对不返回列的语句只执行第一步就重置，execute()每次只回收一页；
+        # executescript()会把语句执行完
+        await self.conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        after = (await self.get_storage_info())["freelist_count"]
+        
+        # 截断WAL文件，释放其占用的磁盘空间
+        await self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return before - after
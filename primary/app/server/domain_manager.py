@@ -3,6 +3,7 @@
 管理特殊域名列表（走新加坡线路）
 """
 
+import asyncio
 import json
 import re
 from typing import List, Dict, Optional
@@ -18,7 +19,10 @@ class DomainManager:
     
     def __init__(self):
         self.domains_file = Path(self.SPECIAL_DOMAINS_FILE)
-        self._ensure_file_exists()
+    
+    async def init(self):
+        """初始化（在线程中检查域名文件，不阻塞事件循环）"""
+        await asyncio.to_thread(self._ensure_file_exists)
     
     def _ensure_file_exists(self):
         """确保域名文件存在"""
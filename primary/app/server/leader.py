@@ -0,0 +1,107 @@
+"""
+主进程选举模块
+uvicorn多worker时，通过文件锁保证只有一个进程负责流量采集、汇总和清理
+"""
+
+import asyncio
+import fcntl
+import os
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+class LeaderElection:
+    """基于flock的主进程选举
+    
+    锁由内核持有，进程退出（包括被kill）时自动释放，
+    其他worker在下一次重试时接管，不会留下失效的锁。
+    """
+    
+    LOCK_FILE = "/var/run/traffic_collector.lock"
+    
+    # 非主进程重试获取锁的间隔（秒）
+    RETRY_INTERVAL = 15
+    
+    def __init__(self,
+                 on_elected: Callable[[], Awaitable[None]],
+                 on_resign: Callable[[], Awaitable[None]],
+                 lock_file: Optional[str] = None):
+        self.lock_file = Path(lock_file or self.LOCK_FILE)
+        self.on_elected = on_elected
+        self.on_resign = on_resign
+        self.is_leader = False
+        self.fd: Optional[int] = None
+        self.task = None
+    
+    @property
+    def role(self) -> str:
+        """当前进程角色"""
+        return "leader" if self.is_leader else "follower"
+    
+    async def start(self):
+        """尝试成为主进程，失败则在后台定期重试"""
+        if await self._try_acquire():
+            return
+        logger.info(f"worker {os.getpid()} 作为从进程运行，仅提供查询服务")
+        self.task = asyncio.create_task(self._retry_loop())
+    
+    async def stop(self):
+        """停止选举并释放锁"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        
+        if self.is_leader:
+            try:
+                await self.on_resign()
+            finally:
+                self._release()
+    
+    async def _retry_loop(self):
+        """定期重试获取锁（主进程退出后接管）"""
+        while not self.is_leader:
+            await asyncio.sleep(self.RETRY_INTERVAL)
+            try:
+                await self._try_acquire()
+            except Exception as e:
+                logger.error(f"主进程选举失败: {e}")
+    
+    async def _try_acquire(self) -> bool:
+        """非阻塞地尝试获取锁，成功后执行on_elected"""
+        self.lock_file.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        
+        # 记录持锁进程，便于排查
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        
+        self.fd = fd
+        self.is_leader = True
+        logger.info(f"worker {os.getpid()} 当选主进程，负责流量采集")
+        try:
+            await self.on_elected()
+        except Exception:
+            self._release()
+            raise
+        return True
+    
+    def _release(self):
+        """释放锁"""
+        if self.fd is not None:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            finally:
+                os.close(self.fd)
+                self.fd = None
+        self.is_leader = False
@@ -0,0 +1,98 @@
+"""
+启动生命周期模块
+记录API启动各阶段耗时和就绪状态
+"""
+
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+class StartupTracker:
+    """启动阶段跟踪器"""
+    
+    def __init__(self):
+        # main.py在完成全部导入后创建跟踪器；启动耗时从进程真正启动时算起，
+        # 解释器启动和导入fastapi、pydantic、httpx及各模块的时间单独记为imports阶段
+        now = time.perf_counter()
+        age = self._process_age()
+        self.process_start = now - age if age is not None else now
+        self.phases: Dict[str, float] = {}
+        if age is not None:
+            self.phases["imports"] = round(age * 1000, 2)
+        self.errors: Dict[str, str] = {}
+        self.ready = False
+        self.ready_at: Optional[float] = None
+    
+    @staticmethod
+    def _process_age() -> Optional[float]:
+        """进程已运行的秒数（读取/proc/self/stat的starttime，非Linux时返回None）
+        
+        starttime是开机后的时钟滴答数，与CLOCK_BOOTTIME相减得到进程年龄。
+        """
+        try:
+            with open("/proc/self/stat") as f:
+                # 第2个字段（进程名）可能含空格和括号，从最后一个")"之后开始数，starttime是第22个字段
+                fields = f.read().rsplit(")", 1)[1].split()
+            start_ticks = int(fields[19])
+            age = time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError, AttributeError):
+            return None
+        return max(0.0, age)
+    
+    @asynccontextmanager
+    async def phase(self, name: str):
+        """记录一个启动阶段的耗时（毫秒）"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.errors[name] = str(e)
+            raise
+        finally:
+            self.phases[name] = round((time.perf_counter() - start) * 1000, 2)
+    
+    async def run_concurrently(self, **steps):
+        """并发执行多个初始化步骤，每个步骤单独计时
+        
+        Args:
+            steps: 阶段名称 -> 协程
+        """
+        async def _timed(name, coro):
+            async with self.phase(name):
+                await coro
+        
+        await asyncio.gather(*(_timed(name, coro) for name, coro in steps.items()))
+    
+    def mark_ready(self):
+        """标记服务就绪"""
+        self.ready = True
+        self.ready_at = time.perf_counter()
+        logger.info(
+            f"API就绪，总耗时{self.total_ms}ms，"
+            f"各阶段: " + ", ".join(f"{k}={v}ms" for k, v in self.phases.items())
+        )
+    
+    def mark_stopping(self):
+        """标记服务正在关闭（不再就绪）"""
+        self.ready = False
+    
+    @property
+    def total_ms(self) -> Optional[float]:
+        """从进程启动到就绪的耗时（毫秒）"""
+        if self.ready_at is None:
+            return None
+        return round((self.ready_at - self.process_start) * 1000, 2)
+    
+    def as_dict(self) -> Dict:
+        """导出启动信息"""
+        return {
+            "ready": self.ready,
+            "total_ms": self.total_ms,
+            "phases": dict(self.phases),
+            "errors": dict(self.errors)
+        }
@@ -0,0 +1,398 @@
+"""
+sing-box日志采集模块
+增量跟踪sing-box日志，按小时聚合DNS查询和出站选择
+"""
+
+import asyncio
+import ctypes
+import os
+import re
+import struct
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+class _Inotify:
+    """最小化的inotify封装（ctypes）
+    
+    监听日志目录的写入、创建和改名事件，用于唤醒采集循环；
+    目录中还有fastapi、nginx等日志，只有文件名以指定前缀开头的事件才唤醒。
+    系统不支持时create()返回None，由调用方退回定时轮询。
+    """
+    
+    IN_MODIFY = 0x002
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    
+    # struct inotify_event: wd, mask, cookie, len，之后是len字节的文件名
+    EVENT_HEADER = struct.Struct("iIII")
+    
+    def __init__(self, fd: int, name_prefix: str):
+        self.fd = fd
+        self.name_prefix = name_prefix.encode()
+        self.event = asyncio.Event()
+    
+    @classmethod
+    def create(cls, directory: str, name_prefix: str) -> Optional["_Inotify"]:
+        """创建目录监听（只关注以name_prefix开头的文件），失败时返回None"""
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(cls.IN_NONBLOCK | cls.IN_CLOEXEC)
+            if fd < 0:
+                return None
+            mask = cls.IN_MODIFY | cls.IN_MOVED_FROM | cls.IN_MOVED_TO | cls.IN_CREATE | cls.IN_DELETE
+            if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+                os.close(fd)
+                return None
+        except (OSError, AttributeError):
+            return None
+        
+        watcher = cls(fd, name_prefix)
+        asyncio.get_running_loop().add_reader(fd, watcher._on_readable)
+        return watcher
+    
+    def _on_readable(self):
+        """读空事件队列，有目标文件的事件时唤醒等待方"""
+        matched = False
+        try:
+            while True:
+                data = os.read(self.fd, 4096)
+                if not data:
+                    break
+                matched = matched or self._matches(data)
+        except BlockingIOError:
+            pass
+        if matched:
+            self.event.set()
+    
+    def _matches(self, data: bytes) -> bool:
+        """一批事件中是否有文件名以name_prefix开头的"""
+        pos = 0
+        while pos + self.EVENT_HEADER.size <= len(data):
+            _, _, _, length = self.EVENT_HEADER.unpack_from(data, pos)
+            pos += self.EVENT_HEADER.size
+            if data[pos:pos + length].rstrip(b"\0").startswith(self.name_prefix):
+                return True
+            pos += length
+        return False
+    
+    async def wait(self, timeout: float):
+        """等待目录变化，超时后返回"""
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+    
+    def close(self):
+        """关闭监听"""
+        asyncio.get_running_loop().remove_reader(self.fd)
+        os.close(self.fd)
+
+class LogIngester:
+    """sing-box日志增量采集器
+    
+    - 字节偏移和文件inode与聚合结果在同一事务中持久化，重启后从断点继续
+    - 通过inode和文件大小识别supervisord的日志轮转和截断，
+      轮转时先读完旧文件（sing-box.log.1）再切换到新文件
+    - 首次运行从文件末尾开始，不回扫历史日志
+    - 每小时每类统计最多保留MAX_DOMAINS_PER_HOUR个域名，其余计入"(other)"
+    
+    注意：DNS缓存命中（cached）只在sing-box日志级别为debug时输出，
+    info级别下缓存未命中率恒为100%。
+    """
+    
+    LOG_FILE = "/var/log/supervisor/sing-box.log"
+    
+    # 每次读取的最大字节数
+    READ_CHUNK = 1024 * 1024
+    
+    # 无inotify事件时的轮询间隔（秒）
+    POLL_INTERVAL = 5
+    
+    # 被唤醒后等待一小段时间，把连续写入合并为一批
+    BATCH_DELAY = 1
+    
+    # 每小时每类统计的域名上限（超出数据库预算时较旧的小时还会合并到前100个）
+    MAX_DOMAINS_PER_HOUR = 1000
+    OTHER_DOMAIN = "(other)"
+    
+    ANSI_RE = re.compile(r'\x1b\[[0-9;]*m')
+    # 例如: +0800 2024-12-09 10:00:00 INFO [1234 0ms] dns: exchanged example.com NOERROR 1
+    TIME_RE = re.compile(r'^[+-]\d{4} (\d{4}-\d{2}-\d{2}) (\d{2}):')
+    DNS_RE = re.compile(r'\bdns: (exchanged|cached) (\S+?)\.?(?:\s|$)')
+    # 例如: outbound/wireguard[wg-sg]: outbound connection to example.com:443
+    OUTBOUND_RE = re.compile(r'\boutbound/[\w-]+\[([^\]]+)\]: outbound (?:packet )?connection to (\S+)')
+    
+    def __init__(self, database, log_file: Optional[str] = None):
+        self.db = database
+        self.path = Path(log_file or self.LOG_FILE)
+        self.running = False
+        self.task = None
+        
+        self.fh = None
+        self.inode: Optional[int] = None
+        self.offset = 0
+        # 正在读取轮转前的旧文件，读完后切换到新文件
+        self.draining_rotated = False
+        
+        # 各小时已记录的域名（用于限制每小时的行数）
+        self.hour_domains: Dict[Tuple[str, str], Set[str]] = {}
+    
+    async def start(self):
+        """启动日志采集"""
+        if self.running:
+            logger.warning("日志采集器已在运行")
+            return
+        
+        self.running = True
+        self.task = asyncio.create_task(self._ingest_loop())
+        logger.info(f"日志采集器已启动: {self.path}")
+    
+    async def stop(self):
+        """停止日志采集"""
+        self.running = False
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self._close_file()
+        logger.info("日志采集器已停止")
+    
+    async def _ingest_loop(self):
+        """采集循环"""
+        watcher = _Inotify.create(str(self.path.parent), self.path.name)
+        if watcher is None:
+            logger.info(f"inotify不可用，每{self.POLL_INTERVAL}秒轮询日志")
+        
+        try:
+            state = await self.db.get_log_state(str(self.path))
+            self._open_initial(state)
+            
+            while self.running:
+                try:
+                    await self._drain()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"日志采集失败: {e}")
+                
+                if watcher:
+                    await watcher.wait(self.POLL_INTERVAL)
+                    await asyncio.sleep(self.BATCH_DELAY)
+                else:
+                    await asyncio.sleep(self.POLL_INTERVAL)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if watcher:
+                watcher.close()
+    
+    # ==================== 文件跟踪 ====================
+    
+    def _open_initial(self, state: Optional[Dict]):
+        """根据持久化的状态打开日志文件"""
+        current = self._stat(self.path)
+        rotated_path = self.path.with_name(self.path.name + ".1")
+        rotated = self._stat(rotated_path)
+        
+        if state and current and current.st_ino == state["inode"]:
+            # 同一个文件，从断点继续（文件被截断时从头开始）
+            offset = state["offset"] if state["offset"] <= current.st_size else 0
+            self._open(self.path, offset)
+        elif state and rotated and rotated.st_ino == state["inode"]:
+            # 停机期间发生过轮转，先读完旧文件
+            self._open(rotated_path, min(state["offset"], rotated.st_size))
+            self.draining_rotated = True
+            logger.info(f"日志在停机期间已轮转，先读取{rotated_path}的剩余部分")
+        elif state and current:
+            # 旧文件已找不到，新文件是断点之后才创建的，从头读取
+            self._open(self.path, 0)
+        elif current:
+            # 首次运行，从末尾开始，不回扫历史日志
+            self._open(self.path, current.st_size)
+            logger.info(f"首次采集，从日志末尾开始（跳过{current.st_size}字节）")
+    
+    def _open(self, path: Path, offset: int):
+        """打开文件并定位到偏移"""
+        self._close_file()
+        self.fh = open(path, "rb")
+        self.inode = os.fstat(self.fh.fileno()).st_ino
+        self.offset = offset
+        self.fh.seek(offset)
+    
+    def _close_file(self):
+        """关闭当前文件"""
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+    
+    @staticmethod
+    def _stat(path: Path) -> Optional[os.stat_result]:
+        """stat文件，不存在时返回None"""
+        try:
+            return path.stat()
+        except FileNotFoundError:
+            return None
+    
+    def _check_rotation(self) -> bool:
+        """读到文件末尾后检查是否发生轮转或截断
+        
+        Returns:
+            True表示已切换文件或重新定位，需要继续读取
+        """
+        current = self._stat(self.path)
+        if current is None:
+            return False
+        
+        if self.fh is None:
+            self._open(self.path, 0)
+            return True
+        
+        if self.draining_rotated:
+            # 旧文件已读完，切换到新文件
+            logger.info("轮转前的日志已读完，切换到新文件")
+            self.draining_rotated = False
+            self._open(self.path, 0)
+            return True
+        
+        if current.st_ino != self.inode:
+            # 轮转前旧文件末尾可能还有刚写入的内容，先再读一遍
+            logger.info("检测到日志轮转")
+            self.draining_rotated = True
+            return True
+        
+        if current.st_size < self.offset:
+            logger.info("检测到日志被截断，从头读取")
+            self._open(self.path, 0)
+            return True
+        
+        return False
+    
+    async def _drain(self):
+        """读取当前文件的全部新增内容，逐批聚合入库"""
+        while True:
+            if self.fh is not None:
+                data = await asyncio.to_thread(self.fh.read, self.READ_CHUNK)
+                end = data.rfind(b"\n")
+                if end >= 0:
+                    # 只处理完整的行，末尾不完整的行留到下次；
+                    # 偏移随聚合一起提交成功后才前移，失败时回到原位置，下次重读这一批
+                    new_offset = self.offset + end + 1
+                    try:
+                        await self._ingest_batch(data[:end + 1], new_offset)
+                    except BaseException:
+                        self.fh.seek(self.offset)
+                        raise
+                    self.offset = new_offset
+                    self.fh.seek(self.offset)
+                    continue
+                # 没有完整的行，回退到上次位置
+                self.fh.seek(self.offset)
+            
+            if not self._check_rotation():
+                return
+    
+    # ==================== 解析和聚合 ====================
+    
+    async def _ingest_batch(self, data: bytes, offset: int):
+        """解析一批日志行并与这批之后的偏移一起写入数据库"""
+        dns, routes = self.parse_lines(data.decode("utf-8", errors="replace"))
+        # 本批新出现的域名，提交成功后才并入hour_domains
+        pending: Dict[Tuple[str, str], Set[str]] = {}
+        dns_rows = []
+        for (hour, domain), (queries, misses) in dns.items():
+            domain = await self._bounded_domain("dns", hour, domain, pending)
+            dns_rows.append((hour, domain, queries, misses))
+        route_rows = []
+        for (hour, domain, outbound), count in routes.items():
+            domain = await self._bounded_domain("route", hour, domain, pending)
+            route_rows.append((hour, domain, outbound, count))
+        
+        # 读取轮转后的旧文件时记录的是旧文件的inode，重启后据此在.1中找回断点
+        await self.db.save_log_batch(
+            dns_rows, route_rows,
+            {"path": str(self.path), "inode": self.inode, "offset": offset}
+        )
+        
+        for key, domains in pending.items():
+            known = self.hour_domains.get(key)
+            if known is not None:
+                known.update(domains)
+    
+    @classmethod
+    def parse_lines(cls, text: str) -> Tuple[Dict, Dict]:
+        """解析日志文本
+        
+        Returns:
+            (dns聚合, 路由聚合)
+            dns聚合: (小时, 域名) -> [查询数, 未命中缓存数]
+            路由聚合: (小时, 域名, 出站) -> 连接数
+        """
+        dns: Dict[Tuple[str, str], list] = {}
+        routes: Dict[Tuple[str, str, str], int] = {}
+        fallback_hour = datetime.now().strftime("%Y-%m-%d %H:00:00")
+        
+        for line in text.splitlines():
+            if "dns: " not in line and "outbound connection to" not in line \
+                    and "outbound packet connection to" not in line:
+                continue
+            line = cls.ANSI_RE.sub("", line)
+            
+            time_match = cls.TIME_RE.match(line)
+            hour = f"{time_match.group(1)} {time_match.group(2)}:00:00" if time_match else fallback_hour
+            
+            match = cls.DNS_RE.search(line)
+            if match:
+                key = (hour, match.group(2).lower())
+                counts = dns.setdefault(key, [0, 0])
+                counts[0] += 1
+                if match.group(1) == "exchanged":
+                    counts[1] += 1
+                continue
+            
+            match = cls.OUTBOUND_RE.search(line)
+            if match:
+                key = (hour, cls._host_of(match.group(2)).lower(), match.group(1))
+                routes[key] = routes.get(key, 0) + 1
+        
+        return dns, routes
+    
+    @staticmethod
+    def _host_of(destination: str) -> str:
+        """从host:port中取出主机部分（支持[IPv6]:port）"""
+        if destination.startswith("["):
+            return destination[1:].split("]", 1)[0]
+        return destination.rsplit(":", 1)[0] if ":" in destination else destination
+    
+    async def _bounded_domain(self, kind: str, hour: str, domain: str,
+                              pending: Dict[Tuple[str, str], Set[str]]) -> str:
+        """超过每小时域名上限时，把新域名归入"(other)"
+        
+        新域名先记入pending，由调用方在本批提交成功后并入hour_domains。
+        """
+        key = (kind, hour)
+        known = self.hour_domains.get(key)
+        if known is None:
+            known = set(await self.db.get_log_domains(kind, hour))
+            self.hour_domains[key] = known
+            # 只保留最近几个小时的集合
+            for old in sorted(k for k in self.hour_domains if k[0] == kind)[:-3]:
+                del self.hour_domains[old]
+        
+        added = pending.setdefault(key, set())
+        if domain in known or domain in added:
+            return domain
+        if len(known) + len(added) >= self.MAX_DOMAINS_PER_HOUR:
+            return self.OTHER_DOMAIN
+        added.add(domain)
+        return domain
@@ -3,17 +3,30 @@ sing-box网关管理后端API
 提供流量统计、域名管理、系统状态查询等功能
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
 from typing import List, Optional
 from datetime import datetime, timedelta
-import asyncio
+from contextlib import asynccontextmanager
+import gzip
+import json
 import logging
+import os
 
 from .database import Database
 from .traffic_collector import TrafficCollector
 from .domain_manager import DomainManager
+from .lifecycle import StartupTracker
+from .leader import LeaderElection
+from .retention import RetentionManager
+from .exporter import TrafficExporter
+from .log_ingester import LogIngester
+from .client_accounting import ClientAccounting
+from .rate_sketch import RateHistogram
+from .config_manager import ConfigManager, ConfigError, ConfigBusyError
+from .clash_api import ClashAPIClient, ClashAPIError, CircuitOpenError
 
 # 配置日志
 logging.basicConfig(
@@ -22,11 +35,75 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 启动阶段跟踪
+startup = StartupTracker()
+
+# 初始化组件（构造函数不做I/O，实际初始化在lifespan中进行）
+db = Database()
+traffic_collector = TrafficCollector(db)
+domain_manager = DomainManager()
+retention_manager = RetentionManager(db)
+exporter = TrafficExporter(db)
+log_ingester = LogIngester(db)
+client_accounting = ClientAccounting(db)
+config_manager = ConfigManager()
+clash_api = ClashAPIClient()
+
+async def start_leader_tasks():
+    """主进程任务：流量采集、客户端统计、日志采集和数据保留"""
+    await traffic_collector.start()
+    await client_accounting.start()
+    await log_ingester.start()
+    await retention_manager.start()
+
+async def stop_leader_tasks():
+    """停止主进程任务"""
+    await retention_manager.stop()
+    await log_ingester.stop()
+    await client_accounting.stop()
+    await traffic_collector.stop()
+
+# 多worker时只有主进程运行采集、汇总和清理，其余worker只提供查询
+leader = LeaderElection(
+    on_elected=start_leader_tasks,
+    on_resign=stop_leader_tasks
+)
+
+# ==================== 启动和关闭 ====================
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：并发初始化组件，采集等后台任务延后启动"""
+    logger.info("正在启动sing-box网关管理API...")
+    
+    # 数据库和域名文件互不依赖，并发初始化
+    await startup.run_concurrently(
+        database=db.init_db(),
+        domain_manager=domain_manager.init(),
+        clash_api=clash_api.start()
+    )
+    
+    # 流量采集在后台运行，不阻塞服务就绪；未当选主进程时只提供查询
+    async with startup.phase("leader_election"):
+        await leader.start()
+    
+    startup.mark_ready()
+    
+    yield
+    
+    logger.info("正在关闭API服务...")
+    startup.mark_stopping()
+    await leader.stop()
+    await clash_api.close()
+    await db.close()
+    logger.info("API服务已关闭")
+
 # 创建FastAPI应用
 app = FastAPI(
     title="sing-box网关管理API",
     description="提供流量统计、域名管理等功能",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
 # 配置CORS
@@ -38,11 +115,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 初始化组件
-db = Database()
-traffic_collector = TrafficCollector(db)
-domain_manager = DomainManager()
-
 # ==================== 数据模型 ====================
 
 class TrafficSnapshot(BaseModel):
@@ -70,6 +142,11 @@ class DomainAddRequest(BaseModel):
     domain: str = Field(description="域名")
     comment: Optional[str] = Field(default=None, description="备注")
 
+class ConfigApplyRequest(BaseModel):
+    """配置变更请求"""
+    rule_sets: Optional[dict] = Field(default=None, description="要更新的本地规则集（tag -> 内容）")
+    dry_run: bool = Field(default=False, description="只渲染、校验和比对，不生效")
+
 class SystemStatus(BaseModel):
     """系统状态"""
     status: str
@@ -78,43 +155,66 @@ class SystemStatus(BaseModel):
     sing_box_version: str
     services: dict
 
-# ==================== 启动和关闭事件 ====================
-
-@app.on_event("startup")
-async def startup_event():
-    """应用启动时执行"""
-    logger.info("正在启动sing-box网关管理API...")
-    
-    # 初始化数据库
-    await db.init_db()
-    logger.info("数据库初始化完成")
-    
-    # 启动流量采集器
-    asyncio.create_task(traffic_collector.start())
-    logger.info("流量采集器已启动")
-    
-    logger.info("API服务启动完成")
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """应用关闭时执行"""
-    logger.info("正在关闭API服务...")
-    await traffic_collector.stop()
-    await db.close()
-    logger.info("API服务已关闭")
-
 # ==================== 健康检查 ====================
 
 @app.get("/api/health")
 async def health_check():
-    """健康检查"""
+    """健康检查（兼容旧版，就绪前返回starting）"""
+    return {
+        "status": "healthy" if startup.ready else "starting",
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.get("/api/health/live")
+async def liveness_check():
+    """存活检查：进程能响应请求即为存活"""
     return {
-        "status": "healthy",
+        "status": "alive",
         "timestamp": datetime.now().isoformat()
     }
 
+@app.get("/api/health/ready")
+async def readiness_check():
+    """就绪检查：组件初始化完成前返回503"""
+    body = {
+        "status": "ready" if startup.ready else "starting",
+        "timestamp": datetime.now().isoformat(),
+        "role": leader.role,
+        "pid": os.getpid(),
+        "startup": startup.as_dict()
+    }
+    if not startup.ready:
+        return JSONResponse(status_code=503, content=body)
+    return body
+
 # ==================== 流量统计API ====================
 
+# 小于该字节数的列式响应不压缩
+GZIP_MIN_SIZE = 1024
+
+def columnar_response(request: Request, stats: List[dict], time_key: str, time_format: str) -> Response:
+    """把统计行转为并列数组，直接编码为JSON（不逐行构造pydantic模型）
+    
+    格式: {"times": [...], "direct": [...], "us": [...], "sg": [...]}
+    客户端支持时gzip压缩。
+    """
+    times = [
+        s[time_key].strftime(time_format) if isinstance(s[time_key], datetime) else s[time_key]
+        for s in stats
+    ]
+    body = json.dumps({
+        "times": times,
+        "direct": [s["direct_total"] for s in stats],
+        "us": [s["us_total"] for s in stats],
+        "sg": [s["sg_total"] for s in stats]
+    }, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    
+    headers = {"Vary": "Accept-Encoding"}
+    if len(body) >= GZIP_MIN_SIZE and "gzip" in request.headers.get("accept-encoding", ""):
+        body = gzip.compress(body, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @app.get("/api/traffic/realtime", response_model=TrafficSnapshot)
 async def get_realtime_traffic():
     """获取实时流量"""
@@ -133,17 +233,22 @@ async def get_realtime_traffic():
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/traffic/hourly", response_model=List[TrafficStats])
-async def get_hourly_traffic(hours: int = 24):
+async def get_hourly_traffic(request: Request, hours: int = 24, format: str = "json"):
     """获取小时级流量统计
     
     Args:
         hours: 获取最近N小时的数据，默认24小时
+        format: json（对象列表）或 columnar（并列数组，适合图表）
     """
     try:
         if hours < 1 or hours > 168:  # 最多7天
             raise HTTPException(status_code=400, detail="hours参数必须在1-168之间")
+        if format not in ("json", "columnar"):
+            raise HTTPException(status_code=400, detail="format参数必须是json或columnar")
         
         stats = await db.get_hourly_stats(hours)
+        if format == "columnar":
+            return columnar_response(request, stats, "hour", "%H:00")
         return [
             TrafficStats(
                 time=s["hour"].strftime("%H:00") if isinstance(s["hour"], datetime) else s["hour"],
@@ -160,17 +265,22 @@ async def get_hourly_traffic(hours: int = 24):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/traffic/daily", response_model=List[TrafficStats])
-async def get_daily_traffic(days: int = 30):
+async def get_daily_traffic(request: Request, days: int = 30, format: str = "json"):
     """获取日级流量统计
     
     Args:
         days: 获取最近N天的数据，默认30天
+        format: json（对象列表）或 columnar（并列数组，适合图表）
     """
     try:
         if days < 1 or days > 90:
             raise HTTPException(status_code=400, detail="days参数必须在1-90之间")
+        if format not in ("json", "columnar"):
+            raise HTTPException(status_code=400, detail="format参数必须是json或columnar")
         
         stats = await db.get_daily_stats(days)
+        if format == "columnar":
+            return columnar_response(request, stats, "date", "%m/%d")
         return [
             TrafficStats(
                 time=s["date"].strftime("%m/%d") if isinstance(s["date"], datetime) else s["date"],
@@ -186,6 +296,161 @@ async def get_daily_traffic(days: int = 30):
         logger.error(f"获取日流量失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/traffic/rates")
+async def get_traffic_rates(resolution: str = "hourly", count: int = 24):
+    """获取各线路的速率分布（p50/p95/峰值，单位字节/秒）
+    
+    直接读取汇总时保存的速率直方图，不扫描原始快照；
+    summary为整个时间范围合并后的结果（可用于95计费）。
+    
+    Args:
+        resolution: hourly 或 daily
+        count: 最近N小时（1-168）或N天（1-90）
+    """
+    try:
+        if resolution not in ("hourly", "daily"):
+            raise HTTPException(status_code=400, detail="resolution参数必须是hourly或daily")
+        limit = 168 if resolution == "hourly" else 90
+        if count < 1 or count > limit:
+            raise HTTPException(status_code=400, detail=f"count参数必须在1-{limit}之间")
+        
+        rows = await db.get_rate_sketches(resolution, count)
+        merged = {line: RateHistogram() for line in ("direct", "us", "sg")}
+        buckets = []
+        for row in rows:
+            bucket = {"time": row["time"]}
+            for line in merged:
+                hist = row["sketches"].get(line, RateHistogram())
+                merged[line].merge(hist)
+                bucket[line] = hist.summary()
+            buckets.append(bucket)
+        
+        return {
+            "resolution": resolution,
+            "unit": "bytes/s",
+            "buckets": buckets,
+            "summary": {line: hist.summary() for line, hist in merged.items()}
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"获取速率分布失败: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/traffic/export")
+async def export_traffic(
+    format: str = "csv",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    resolution: str = "hourly",
+    compress: bool = Query(False, alias="gzip")
+):
+    """流式导出流量历史（用于对账）
+    
+    Args:
+        format: csv 或 ndjson
+        start: 起始时间（含），默认结束时间前30天
+        end: 结束时间（不含），默认当前时间
+        resolution: snapshot / hourly / daily
+        compress: 是否gzip压缩（查询参数名为gzip）
+    """
+    if format not in TrafficExporter.FORMATS:
+        raise HTTPException(status_code=400, detail="format参数必须是csv或ndjson")
+    if resolution not in TrafficExporter.RESOLUTIONS:
+        raise HTTPException(status_code=400, detail="resolution参数必须是snapshot、hourly或daily")
+    
+    start, end = TrafficExporter.local_naive(start), TrafficExporter.local_naive(end)
+    end = end or datetime.now()
+    start = start or end - timedelta(days=30)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start必须早于end")
+    
+    filename = exporter.filename(format, resolution, start, end, compress)
+    return StreamingResponse(
+        exporter.stream(format, resolution, start, end, compress=compress),
+        media_type=exporter.media_type(format, compress),
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            # 关闭nginx响应缓冲，边查边发
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+# ==================== 客户端统计API ====================
+
+@app.get("/api/clients")
+async def get_client_traffic(hours: int = 24, limit: int = 100):
+    """获取局域网各客户端的流量（需开启CLIENT_ACCOUNTING）
+    
+    Args:
+        hours: 统计最近N小时，默认24小时
+        limit: 返回的客户端数量，默认100
+    """
+    try:
+        if hours < 1 or hours > 168:
+            raise HTTPException(status_code=400, detail="hours参数必须在1-168之间")
+        if limit < 1 or limit > 1000:
+            raise HTTPException(status_code=400, detail="limit参数必须在1-1000之间")
+        
+        clients = await db.get_client_stats(hours, limit) if client_accounting.enabled else []
+        return {
+            "enabled": client_accounting.enabled,
+            "subnet": client_accounting.subnet,
+            "clients": clients
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"获取客户端流量失败: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ==================== DNS和路由分析API ====================
+
+@app.get("/api/analytics/dns")
+async def get_dns_analytics(hours: int = 24, limit: int = 50):
+    """获取DNS查询统计（查询最多的域名及缓存未命中率）
+    
+    Args:
+        hours: 统计最近N小时，默认24小时
+        limit: 返回的域名数量，默认50
+    """
+    try:
+        if hours < 1 or hours > 168:
+            raise HTTPException(status_code=400, detail="hours参数必须在1-168之间")
+        if limit < 1 or limit > 1000:
+            raise HTTPException(status_code=400, detail="limit参数必须在1-1000之间")
+        
+        stats = await db.get_dns_stats(hours, limit)
+        for s in stats:
+            s["miss_rate"] = round(s["cache_misses"] / s["queries"], 4) if s["queries"] else 0
+        return stats
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"获取DNS统计失败: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/analytics/routes")
+async def get_route_analytics(hours: int = 24, limit: int = 50):
+    """获取出站选择统计（各出站连接数及连接最多的域名）
+    
+    Args:
+        hours: 统计最近N小时，默认24小时
+        limit: 返回的域名数量，默认50
+    """
+    try:
+        if hours < 1 or hours > 168:
+            raise HTTPException(status_code=400, detail="hours参数必须在1-168之间")
+        if limit < 1 or limit > 1000:
+            raise HTTPException(status_code=400, detail="limit参数必须在1-1000之间")
+        
+        return await db.get_route_stats(hours, limit)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"获取路由统计失败: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 # ==================== 域名管理API ====================
 
 @app.get("/api/domains", response_model=List[DomainItem])
@@ -248,6 +513,78 @@ async def delete_domain(domain: str):
         logger.error(f"删除域名失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# ==================== 配置管理API ====================
+
+@app.get("/api/config/diff")
+async def diff_config():
+    """渲染并校验候选配置，返回与运行配置的差异（不生效）"""
+    return await apply_config(ConfigApplyRequest(dry_run=True))
+
+@app.post("/api/config/apply")
+async def apply_config(request: ConfigApplyRequest):
+    """渲染、校验、比对并以影响最小的方式生效"""
+    try:
+        return await config_manager.apply(rule_sets=request.rule_sets, dry_run=request.dry_run)
+    except ConfigBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ConfigError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        logger.error(f"配置变更失败: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/config/status")
+async def get_config_status():
+    """获取本worker最近一次配置变更的结果和各阶段耗时"""
+    return {"last_result": config_manager.last_result}
+
+# ==================== Clash API ====================
+
+@app.get("/api/clash/traffic")
+async def get_clash_traffic():
+    """从sing-box读取一个实时速率样本（字节/秒）"""
+    try:
+        return await clash_api.traffic_sample()
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ClashAPIError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+@app.get("/api/clash/connections")
+async def get_clash_connections(limit: int = 0):
+    """获取sing-box当前连接数和累计上下行字节，limit>0时附带连接明细"""
+    try:
+        data = await clash_api.connections()
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ClashAPIError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    
+    connections = data.get("connections") or []
+    result = {
+        "count": len(connections),
+        "upload_total": data.get("uploadTotal", 0),
+        "download_total": data.get("downloadTotal", 0)
+    }
+    if limit > 0:
+        result["connections"] = connections[:limit]
+    return result
+
+@app.get("/api/clash/proxies/{name}/delay")
+async def get_clash_proxy_delay(name: str, url: str = "https://www.gstatic.com/generate_204",
+                                timeout: int = 5000):
+    """测试出站延迟（毫秒）"""
+    try:
+        return await clash_api.proxy_delay(name, url, timeout)
+    except ClashAPIError as e:
+        # 出站不通时透传sing-box的503/504，未收到响应时返回502
+        raise HTTPException(status_code=e.status_code or 502, detail=str(e))
+
+@app.get("/api/clash/stats")
+async def get_clash_stats():
+    """获取本worker调用Clash API的熔断状态、次数和耗时"""
+    return clash_api.stats()
+
 # ==================== 系统状态API ====================
 
 @app.get("/api/status", response_model=SystemStatus)
@@ -0,0 +1,107 @@
+"""
+速率分布模块
+用固定对数分桶直方图记录每个采样间隔的速率，可直接相加合并，用于计算p50/p95
+"""
+
+import json
+import math
+from typing import Dict, Optional
+
+class RateHistogram:
+    """固定对数分桶的速率直方图
+    
+    桶边界为 2^(i/BUCKETS_PER_OCTAVE) 字节/秒，分位数取桶的几何中点，
+    相对误差不超过 2^(1/16)-1 ≈ 4.4%；
+    速率为0单独计入第0桶。分桶固定，小时直方图逐桶相加即得日直方图。
+    """
+    
+    # 每翻一倍划分的桶数
+    BUCKETS_PER_OCTAVE = 8
+    
+    def __init__(self, counts: Optional[Dict[int, int]] = None, max_rate: float = 0.0):
+        self.counts: Dict[int, int] = dict(counts or {})
+        self.max_rate = max_rate
+    
+    @classmethod
+    def bucket_of(cls, rate: float) -> int:
+        """速率所属的桶（0表示速率为0，1表示(0, 1]字节/秒）"""
+        if rate <= 0:
+            return 0
+        if rate <= 1:
+            return 1
+        return 1 + math.ceil(math.log2(rate) * cls.BUCKETS_PER_OCTAVE)
+    
+    @classmethod
+    def upper_bound(cls, bucket: int) -> float:
+        """桶的上边界（字节/秒）"""
+        if bucket <= 0:
+            return 0.0
+        return 2 ** ((bucket - 1) / cls.BUCKETS_PER_OCTAVE)
+    
+    @classmethod
+    def midpoint(cls, bucket: int) -> float:
+        """桶的几何中点（字节/秒），(0, 1]桶取上边界"""
+        if bucket <= 1:
+            return cls.upper_bound(bucket)
+        return 2 ** ((bucket - 1.5) / cls.BUCKETS_PER_OCTAVE)
+    
+    def add(self, rate: float):
+        """记录一个采样间隔的速率"""
+        bucket = self.bucket_of(rate)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.max_rate = max(self.max_rate, rate)
+    
+    def merge(self, other: "RateHistogram") -> "RateHistogram":
+        """合并另一个直方图（原地修改并返回自身）"""
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.max_rate = max(self.max_rate, other.max_rate)
+        return self
+    
+    @property
+    def total(self) -> int:
+        """采样间隔数"""
+        return sum(self.counts.values())
+    
+    def quantile(self, q: float) -> float:
+        """估算分位数（返回所在桶的几何中点，不超过最大速率）"""
+        total = self.total
+        if total == 0:
+            return 0.0
+        rank = max(1, math.ceil(q * total))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.midpoint(bucket), self.max_rate)
+        return self.max_rate
+    
+    def summary(self) -> Dict:
+        """p50/p95/最大速率（字节/秒）"""
+        return {
+            "p50": round(self.quantile(0.50), 2),
+            "p95": round(self.quantile(0.95), 2),
+            "max": round(self.max_rate, 2),
+            "samples": self.total
+        }
+    
+    def to_dict(self) -> Dict:
+        """序列化（JSON的键只能是字符串）"""
+        return {"max": self.max_rate, "counts": {str(k): v for k, v in self.counts.items()}}
+    
+    @classmethod
+    def from_dict(cls, data: Optional[Dict]) -> "RateHistogram":
+        """反序列化"""
+        if not data:
+            return cls()
+        return cls({int(k): v for k, v in data.get("counts", {}).items()}, data.get("max", 0.0))
+
+def dump_sketches(sketches: Dict[str, RateHistogram]) -> str:
+    """把各线路的直方图编码为JSON"""
+    return json.dumps({line: hist.to_dict() for line, hist in sketches.items()}, separators=(",", ":"))
+
+def load_sketches(text: Optional[str]) -> Dict[str, RateHistogram]:
+    """从JSON解码各线路的直方图"""
+    if not text:
+        return {}
+    return {line: RateHistogram.from_dict(data) for line, data in json.loads(text).items()}
@@ -0,0 +1,218 @@
+"""
+数据保留模块
+按层级清理过期数据，增量回收空闲页，并把数据库控制在磁盘预算内
+"""
+
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+class RetentionPolicy:
+    """保留策略（可通过环境变量覆盖）"""
+    
+    def __init__(self,
+                 snapshot_hours: int = 24,
+                 hourly_days: int = 7,
+                 daily_days: int = 90,
+                 max_db_mb: float = 64):
+        self.snapshot_hours = snapshot_hours
+        self.hourly_days = hourly_days
+        self.daily_days = daily_days
+        self.max_db_bytes = int(max_db_mb * 1024 * 1024)
+    
+    @classmethod
+    def from_env(cls) -> "RetentionPolicy":
+        """从环境变量读取保留策略"""
+        return cls(
+            snapshot_hours=int(os.environ.get("TRAFFIC_SNAPSHOT_RETENTION_HOURS", 24)),
+            hourly_days=int(os.environ.get("TRAFFIC_HOURLY_RETENTION_DAYS", 7)),
+            daily_days=int(os.environ.get("TRAFFIC_DAILY_RETENTION_DAYS", 90)),
+            max_db_mb=float(os.environ.get("TRAFFIC_DB_MAX_MB", 64))
+        )
+    
+    def as_dict(self) -> Dict:
+        """导出策略"""
+        return {
+            "snapshot_hours": self.snapshot_hours,
+            "hourly_days": self.hourly_days,
+            "daily_days": self.daily_days,
+            "max_db_bytes": self.max_db_bytes
+        }
+
+class RetentionManager:
+    """数据保留管理器（只在主进程运行）"""
+    
+    # 执行间隔（秒）
+    RUN_INTERVAL = 3600
+    
+    # 启动后首次执行的延迟（秒），避开启动阶段
+    INITIAL_DELAY = 120
+    
+    # 每次增量回收的最大页数
+    VACUUM_PAGES = 1024
+    
+    # 超出预算时快照降采样的桶宽（秒）
+    COMPACT_BUCKET = 600
+    
+    # 降采样时至少保留的原始精度范围
+    MIN_FULL_RES_SNAPSHOTS = timedelta(hours=1)
+    MIN_HOURLY = timedelta(days=1)
+    MIN_LOG_DETAIL = timedelta(hours=6)
+    
+    # 超出预算时日志分析统计每小时保留的域名数（其余合并为"(other)"）
+    LOG_FOLD_TOP = 100
+    
+    def __init__(self, database, policy: Optional[RetentionPolicy] = None):
+        self.db = database
+        self.policy = policy or RetentionPolicy.from_env()
+        self.running = False
+        self.task = None
+    
+    async def start(self):
+        """启动定期维护"""
+        if self.running:
+            logger.warning("数据保留管理器已在运行")
+            return
+        
+        self.running = True
+        self.task = asyncio.create_task(self._maintenance_loop())
+        logger.info(f"数据保留管理器已启动: {self.policy.as_dict()}")
+    
+    async def stop(self):
+        """停止定期维护"""
+        self.running = False
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        logger.info("数据保留管理器已停止")
+    
+    async def _maintenance_loop(self):
+        """维护循环"""
+        await asyncio.sleep(self.INITIAL_DELAY)
+        
+        try:
+            await self.db.enable_incremental_vacuum()
+        except Exception as e:
+            logger.error(f"启用增量回收失败: {e}")
+        
+        while self.running:
+            try:
+                await self.run()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"数据保留维护失败: {e}")
+            
+            await asyncio.sleep(self.RUN_INTERVAL)
+    
+    async def run(self) -> Dict:
+        """执行一次维护：按层级清理、回收空闲页、检查磁盘预算"""
+        started = datetime.now()
+        result = {
+            "snapshots_deleted": await self.db.cleanup_old_snapshots(hours=self.policy.snapshot_hours),
+            "hourly_deleted": await self.db.cleanup_old_hourly_stats(days=self.policy.hourly_days),
+            "daily_deleted": await self.db.cleanup_old_daily_stats(days=self.policy.daily_days),
+            "log_stats_deleted": await self.db.cleanup_old_log_stats(days=self.policy.hourly_days),
+            "client_stats_deleted": await self.db.cleanup_old_client_stats(days=self.policy.hourly_days),
+            "pages_vacuumed": await self._vacuum(),
+            "downsampled": await self._enforce_budget()
+        }
+        
+        storage = await self.db.get_storage_info()
+        result["size_bytes"] = storage["size_bytes"]
+        result["duration_ms"] = round((datetime.now() - started).total_seconds() * 1000, 2)
+        logger.info(f"数据保留维护完成: {result}")
+        return result
+    
+    async def _vacuum(self) -> int:
+        """分批回收空闲页，每批之间让出事件循环"""
+        total = 0
+        while True:
+            freed = await self.db.incremental_vacuum(self.VACUUM_PAGES)
+            total += freed
+            if freed < self.VACUUM_PAGES:
+                return total
+            await asyncio.sleep(0)
+    
+    async def _enforce_budget(self) -> Dict:
+        """超出磁盘预算时，从最旧的数据开始降采样而不是直接删除
+        
+        逐步收紧范围：先把较旧的日志分析统计合并为每小时前LOG_FOLD_TOP个域名（行数最多、价值最低），
+        再把较旧的分钟快照合并为10分钟桶，最后把较旧的小时统计折叠进日统计，每步之后重新测量。
+        某一步处理了数据但文件没有变小时停止，不再继续降低精度。
+        """
+        downsampled = {"log_domains": 0, "snapshots": 0, "hourly": 0}
+        if await self._within_budget():
+            return downsampled
+        
+        logger.warning(f"数据库超出预算{self.policy.max_db_bytes}字节，开始降采样")
+        now = datetime.now()
+        
+        # 日志分析统计：从保留期的一半开始，逐步缩小到只保留最近6小时的完整域名
+        keep = timedelta(days=self.policy.hourly_days) / 2
+        while True:
+            changed, shrank = await self._downsample_step(
+                self.db.fold_log_domains(before=now - keep, keep_top=self.LOG_FOLD_TOP)
+            )
+            downsampled["log_domains"] += changed
+            if not shrank:
+                return downsampled
+            if await self._within_budget():
+                return downsampled
+            if keep <= self.MIN_LOG_DETAIL:
+                break
+            keep = max(keep / 2, self.MIN_LOG_DETAIL)
+        
+        # 快照：从保留期的一半开始，逐步缩小到只保留最近1小时的分钟精度
+        full_res = timedelta(hours=self.policy.snapshot_hours) / 2
+        while full_res >= self.MIN_FULL_RES_SNAPSHOTS:
+            changed, shrank = await self._downsample_step(self.db.compact_snapshots(
+                before=now - full_res, bucket_seconds=self.COMPACT_BUCKET
+            ))
+            downsampled["snapshots"] += changed
+            if not shrank:
+                return downsampled
+            if await self._within_budget():
+                return downsampled
+            full_res /= 2
+        
+        # 小时统计：逐步缩短保留期，最少保留1天
+        keep = timedelta(days=self.policy.hourly_days) / 2
+        while keep >= self.MIN_HOURLY:
+            changed, shrank = await self._downsample_step(self.db.downsample_hourly_stats(before=now - keep))
+            downsampled["hourly"] += changed
+            if not shrank:
+                return downsampled
+            if await self._within_budget():
+                return downsampled
+            keep /= 2
+        
+        logger.warning("降采样后数据库仍超出预算，请调大TRAFFIC_DB_MAX_MB")
+        return downsampled
+    
+    async def _downsample_step(self, step) -> Tuple[int, bool]:
+        """执行一步降采样并回收空闲页
+        
+        Returns:
+            (处理的行数, 是否可以继续)：处理了数据但文件没有变小时为False，调用方应停止降采样
+        """
+        before = (await self.db.get_storage_info())["size_bytes"]
+        changed = await step
+        await self._vacuum()
+        after = (await self.db.get_storage_info())["size_bytes"]
+        if changed and after >= before:
+            logger.warning(f"降采样处理了{changed}行但数据库没有变小（{after}字节），停止降采样")
+            return changed, False
+        return changed, True
+    
+    async def _within_budget(self) -> bool:
+        """数据库文件是否在磁盘预算内"""
+        storage = await self.db.get_storage_info()
+        return storage["size_bytes"] <= self.policy.max_db_bytes
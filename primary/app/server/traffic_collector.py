@@ -6,8 +6,10 @@
 import asyncio
 import subprocess
 import re
+import time
 from datetime import datetime
-from typing import Dict, Tuple
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
@@ -21,17 +23,22 @@ class TrafficCollector:
     VPS9_ADDR = "212.64.83.18"   # 新加坡线路
     VPS9_PORT = "51822"
     
+    # 采集间隔（秒）
+    SAMPLE_INTERVAL = 60
+    
+    # iptables链建立时间标记（entrypoint.sh / setup_iptables_rules 写入）
+    CHAIN_EPOCH_FILE = "/var/lib/sing-box/iptables_epoch"
+    
+    # 断档回填的最大分片数（按分钟计，对应快照保留的24小时）
+    MAX_BACKFILL_SLOTS = 24 * 60
+    
     def __init__(self, database):
         self.db = database
         self.running = False
         self.task = None
         
-        # 上一次的计数器值（用于计算增量）
-        self.last_counters = {
-            "total": 0,
-            "us": 0,
-            "sg": 0
-        }
+        # 上一次的计数器基线（用于计算增量），启动后从数据库加载
+        self.checkpoint: Optional[Dict] = None
     
     async def start(self):
         """启动采集器"""
@@ -56,28 +63,15 @@ class TrafficCollector:
     
     async def _collect_loop(self):
         """采集循环"""
-        # 等待系统启动完成
-        await asyncio.sleep(10)
-        
+        # 计数器基线已持久化，启动后可立即采集第一个样本
         while self.running:
             try:
                 # 采集流量数据
                 await self._collect_traffic()
                 
-                # 每分钟采集一次
-                await asyncio.sleep(60)
-                
-                # 每小时更新一次小时统计
-                if datetime.now().minute == 0:
-                    await self.db.update_hourly_stats()
-                    await self.db.cleanup_old_snapshots(hours=24)
-                
-                # 每天凌晨更新日统计
-                if datetime.now().hour == 0 and datetime.now().minute == 0:
-                    await self.db.update_daily_stats()
-                    await self.db.cleanup_old_hourly_stats(days=7)
-                    await self.db.cleanup_old_daily_stats(days=90)
-                
+                # 每分钟采集一次（汇总随每个样本进行，过期数据由RetentionManager清理）
+                await asyncio.sleep(self.SAMPLE_INTERVAL)
+            
             except asyncio.CancelledError:
                 break
             except Exception as e:
@@ -85,38 +79,155 @@ class TrafficCollector:
                 await asyncio.sleep(60)
     
     async def _collect_traffic(self):
-        """采集流量数据"""
+        """采集流量数据
+        
+        增量以持久化的检查点为基线计算，快照和新检查点在同一事务中写入，
+        因此API重启后不会把累计计数器整体计入一分钟。
+        """
         try:
             # 读取iptables计数器
             total_bytes, us_bytes, sg_bytes = await self._read_iptables_counters()
+            now = time.time()
+            counters = {
+                "total_bytes": total_bytes,
+                "us_bytes": us_bytes,
+                "sg_bytes": sg_bytes,
+                "direct_bytes": max(0, total_bytes - us_bytes - sg_bytes)
+            }
+            chain_epoch = self._read_chain_epoch()
             
-            # 计算增量（本分钟的流量）
-            direct_bytes = max(0, total_bytes - us_bytes - sg_bytes)
-            us_increment = max(0, us_bytes - self.last_counters["us"])
-            sg_increment = max(0, sg_bytes - self.last_counters["sg"])
-            direct_increment = max(0, direct_bytes - self.last_counters.get("direct", 0))
-            
-            # 保存快照
-            await self.db.save_snapshot(
-                direct_bytes=direct_increment,
-                us_bytes=us_increment,
-                sg_bytes=sg_increment
-            )
+            if self.checkpoint is None:
+                self.checkpoint = await self.db.get_collector_checkpoint()
             
-            # 更新上一次的计数器
-            self.last_counters = {
-                "total": total_bytes,
-                "us": us_bytes,
-                "sg": sg_bytes,
-                "direct": direct_bytes
-            }
+            samples = self._build_samples(self.checkpoint, counters, chain_epoch, now)
+            checkpoint = {"sample_ts": now, "chain_epoch": chain_epoch, **counters}
+            
+            # 快照与基线一起提交
+            await self.db.save_samples(samples, checkpoint)
+            self.checkpoint = checkpoint
             
-            logger.debug(f"流量采集: 直连={direct_increment}, 美国={us_increment}, 新加坡={sg_increment}")
+            # 重新汇总样本所在的小时和天
+            await self._rollup(samples)
             
+            if samples:
+                logger.debug(
+                    f"流量采集: 直连={sum(s['direct_bytes'] for s in samples)}, "
+                    f"美国={sum(s['us_bytes'] for s in samples)}, "
+                    f"新加坡={sum(s['sg_bytes'] for s in samples)}, 分片={len(samples)}"
+                )
+        
         except Exception as e:
             logger.error(f"采集流量数据失败: {e}")
             raise
     
+    def _build_samples(self, checkpoint: Optional[Dict], counters: Dict,
+                       chain_epoch: Optional[str], now: float) -> List[Dict]:
+        """根据检查点和当前计数器生成快照
+        
+        - 无检查点：只建立基线，不计入任何流量
+        - 计数器回退或链被重建（epoch变化）：视为计数器复位，
+          当前计数即为复位后的流量，首个分片标记为断档
+        - 距上次采样超过一个采集间隔：把增量按分钟平均插值到各分片
+        
+        Args:
+            checkpoint: 上一次的计数器基线
+            counters: 当前计数器（total/us/sg/direct）
+            chain_epoch: 当前iptables链的建立时间标记
+            now: 当前采样时间（Unix时间戳）
+        
+        Returns:
+            快照列表
+        """
+        if checkpoint is None:
+            logger.info("未找到采集检查点，建立计数器基线")
+            return []
+        
+        start = checkpoint["sample_ts"]
+        epoch_changed = (
+            chain_epoch is not None
+            and checkpoint.get("chain_epoch") is not None
+            and chain_epoch != checkpoint["chain_epoch"]
+        )
+        counter_dropped = any(
+            counters[key] < checkpoint[key]
+            for key in ("total_bytes", "us_bytes", "sg_bytes")
+        )
+        reset = epoch_changed or counter_dropped
+        
+        if reset:
+            # 复位前最后一段流量已不可知，复位后的流量就是当前计数
+            deltas = {key: counters[key] for key in ("direct_bytes", "us_bytes", "sg_bytes")}
+            epoch_ts = self._parse_epoch(chain_epoch)
+            if epoch_ts is not None and start < epoch_ts <= now:
+                start = epoch_ts
+            logger.warning(
+                f"检测到流量计数器复位（链重建={epoch_changed}, 计数回退={counter_dropped}），"
+                f"标记断档"
+            )
+        else:
+            deltas = {
+                key: max(0, counters[key] - checkpoint[key])
+                for key in ("direct_bytes", "us_bytes", "sg_bytes")
+            }
+        
+        elapsed = now - start
+        if elapsed <= 0:
+            # 时钟回拨等异常情况，按一个采集间隔计
+            elapsed = self.SAMPLE_INTERVAL
+        slots = min(self.MAX_BACKFILL_SLOTS, max(1, round(elapsed / self.SAMPLE_INTERVAL)))
+        if slots > 1:
+            logger.info(f"距上次采样{int(elapsed)}秒，增量插值到{slots}个分片")
+        
+        width = elapsed / slots
+        samples = []
+        for i in range(slots):
+            sample = {
+                "timestamp": datetime.fromtimestamp(now - (slots - 1 - i) * width),
+                "interval_seconds": width,
+                "gap": reset and i == 0
+            }
+            for key, delta in deltas.items():
+                # 余数计入最后一个分片，保证总量不变
+                share = delta // slots
+                sample[key] = share + (delta - share * slots if i == slots - 1 else 0)
+            samples.append(sample)
+        return samples
+    
+    async def _rollup(self, samples: List[Dict]):
+        """重新汇总样本落入的每个小时和每一天
+        
+        每个样本写入后立即汇总所在小时，小时的最后一个样本写入时该小时即最终确定，
+        不依赖采集循环恰好在整点运行（循环周期会漂移）；回填跨越的已结束时段一并补做。
+        """
+        hours = sorted({s["timestamp"].replace(minute=0, second=0, microsecond=0) for s in samples})
+        if not hours:
+            return
+        
+        for hour in hours:
+            await self.db.update_hourly_stats(hour=hour)
+        for day in sorted({hour.date() for hour in hours}):
+            await self.db.update_daily_stats(day=day)
+        if len(hours) > 1:
+            logger.info(f"补做回填时段的汇总: {len(hours)}个小时")
+    
+    def _read_chain_epoch(self) -> Optional[str]:
+        """读取iptables链的建立时间标记（文件不存在时返回None）"""
+        try:
+            return Path(self.CHAIN_EPOCH_FILE).read_text().strip() or None
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"读取链建立标记失败: {e}")
+            return None
+    
+    @staticmethod
+    def _parse_epoch(chain_epoch: Optional[str]) -> Optional[float]:
+        """解析链建立标记中的时间戳"""
+        try:
+            return float(chain_epoch) if chain_epoch else None
+        except ValueError:
+            return None
+    
     async def _read_iptables_counters(self) -> Tuple[int, int, int]:
         """读取iptables计数器
         
@@ -124,18 +235,23 @@ class TrafficCollector:
             (总流量, 美国流量, 新加坡流量) 单位：字节
         """
         try:
-            # 读取iptables统计
-            result = subprocess.run(
-                ["iptables", "-L", "OUTPUT", "-v", "-n", "-x"],
-                capture_output=True,
-                text=True,
-                timeout=5
+            # 读取iptables统计（异步子进程，不阻塞事件循环）
+            proc = await asyncio.create_subprocess_exec(
+                "iptables", "-L", "OUTPUT", "-v", "-n", "-x",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
             )
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=5)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise
             
-            if result.returncode != 0:
-                raise Exception(f"iptables命令失败: {result.stderr}")
+            if proc.returncode != 0:
+                raise Exception(f"iptables命令失败: {stderr.decode(errors='replace')}")
             
-            output = result.stdout
+            output = stdout.decode(errors="replace")
             
             # 解析输出
             total_bytes = self._parse_chain_bytes(output, "TRAFFIC_TOTAL")
@@ -143,8 +259,8 @@ class TrafficCollector:
             sg_bytes = self._parse_chain_bytes(output, "TRAFFIC_SG")
             
             return total_bytes, us_bytes, sg_bytes
-            
-        except subprocess.TimeoutExpired:
+        
+        except asyncio.TimeoutError:
             logger.error("iptables命令超时")
             raise
         except Exception as e:
@@ -175,7 +291,7 @@ class TrafficCollector:
             else:
                 logger.warning(f"未找到链 {chain_name} 的统计信息")
                 return 0
-                
+        
         except Exception as e:
             logger.error(f"解析链 {chain_name} 失败: {e}")
             return 0
@@ -217,8 +333,13 @@ class TrafficCollector:
                 "-j", "TRAFFIC_TOTAL"
             ])
             
-            logger.info("iptables流量统计规则设置完成")
+            # 记录链建立时间，采集器据此识别计数器复位
+            epoch_file = Path(cls.CHAIN_EPOCH_FILE)
+            epoch_file.parent.mkdir(parents=True, exist_ok=True)
+            epoch_file.write_text(f"{time.time():.0f}\n")
             
+            logger.info("iptables流量统计规则设置完成")
+        
         except Exception as e:
             logger.error(f"设置iptables规则失败: {e}")
             raise